@@ -1,205 +1,138 @@
-import pandas as pd
 import streamlit as st
-import folium
 from streamlit_folium import st_folium
-from folium.plugins import MarkerCluster
-from folium.plugins import  HeatMap
-import geopandas as gpd
-from shapely.geometry import MultiPoint, Polygon, Point
-from sklearn.cluster import DBSCAN
-from sklearn.cluster import KMeans
-import numpy as np
+
+from avalanche_analysis import pipeline, playback, profiling, tracks
+from avalanche_analysis.render import START_ZOOM, LayerSync, base_map
+from avalanche_analysis.seasons import FIRST_MONTH, MONTH_NAMES, TimeWindow, season_label
 
 st.set_page_config(layout="wide")
 
 file_path = "CAIC_Accident_Data_Nov_2024.xlsx"
-df = pd.read_excel(file_path)
-
-df = df[(df["lat"] != 0.0) & (df["lon"] != 0.0)]
-print(df[['lat', 'lon']].describe())
-
-
-df["lat"] = pd.to_numeric(df["lat"], errors="coerce")
-df["lon"] = pd.to_numeric(df["lon"], errors="coerce")
-
-
-df['PrimaryActivity'] = df['PrimaryActivity'].str.lower().str.replace(" ","_")
-
-# Define mapping dictionary
-traveler_mapping = {
-    "backcountry_tourer": "skier",
-    "ski_patroller": "skier",
-    "sidecountry_rider": "skier",
-    "inbounds_rider": "skier",
-    "hybrid_tourer": "skier",
-    "human-powered_guide_client": "skier",
-    
-    "snowmobiler": "mechanized",
-    "mechanised_guide": "mechanized",
-    "mechanized_guided_client": "mechanized",
-    "mechanized_guide": "mechanized",
-    "mechanized_guiding_client": "mechanized",
-    "snowbiker": "mechanized",
-    "motorist": "mechanized",
-
-    "hiker": "hiker",
-    "climber": "hiker",
-    "snowplayer": "hiker",
-    "hunter": "hiker",
-    "hybrid_rider": "hiker",
-    "misc_recreation": "hiker",
-
-    "miner": "occupational_hazard",
-    "rescuer": "occupational_hazard",
-    "ranger": "occupational_hazard",
-    "highway_personnel": "occupational_hazard",
-    "others_at_work": "occupational_hazard",
-
-    
-    "resident": "miscellaneous"
-}
-
-# Apply mapping to the dataframe
-df["PrimaryActivity"] = df["PrimaryActivity"].map(traveler_mapping)
-
-# Check unique categories to confirm mapping worked
-#print(df["PrimaryActivity"].unique())
-
-# Color Code for Activity Type:
-colordict  = {
-    "skier": "rgba(0, 0, 255, 0.5)",  # Blue with 50% opacity
-    "mechanized": "rgba(255, 0, 0, 0.5)",  # Red with 50% opacity
-    "hiker": "rgba(0, 255, 0, 0.5)",  # Green with 50% opacity
-    "occupational_hazard": "rgba(255, 165, 0, 0.5)",  # Orange with 50% opacity
-    "miscellaneous": "rgba(128, 128, 128, 0.5)"  # Gray with 50% opacity
-}
-
 
+# Every stage is memoized process-wide on its inputs, so reruns only redo
+# the stages whose inputs changed.
+version = pipeline.source_version(file_path)
+df = pipeline.normalize(file_path, version)
 
-
-
-# Streamlit:
-
-# Convert year to integer in case it is a string:
-df["YYYY"] = df["YYYY"].astype(int)
-
-## Dropdown to select the year:
-#selected_year = st.sidebar.selectbox("Select a Year", sorted(df["YYYY"].unique()), index=0)
-
-## Filter the data based on selected year:
-#df_filtered = df[df["YYYY"] == selected_year]
-df_filtered = df
-
-# Sidebar filter for activity types
-traveler_filter = st.sidebar.multiselect(
-    "Filter by Traveler Type", df["PrimaryActivity"].unique(), default=df["PrimaryActivity"].unique()
+mode = st.sidebar.radio(
+    "Map", ["Clusters", "Filter in the browser", "Season playback"],
+    help="Filter in the browser: send every traveler-type combination once, so toggling types needs no rerun "
+         f"(all seasons). Season playback: animate the clusters of each trailing {playback.SPAN}-season window.",
 )
 
-# Apply the filter
-df_filtered = df_filtered[df_filtered["PrimaryActivity"].isin(traveler_filter)]
-
-## Convert lat/lon to numpy array for clustering:
-coords = df_filtered[['lat', 'lon']].values
-
-# Convert miles to radians:
-eps_distance = 7/3958.8
-
-# # Apply DBSCAN clustering
-# clustering = DBSCAN(eps=eps_distance, min_samples=1,metric='haversine').fit(np.radians(coords))
-
-num_clusters = min(3, len(df_filtered))  # Prevents more clusters than points
-
-if num_clusters > 1:  # Only run DBSCAN if we have enough points
-    clustering = DBSCAN(eps=eps_distance, min_samples=2, metric='haversine').fit(np.radians(coords))
-    df_filtered.loc[:, "cluster"] = clustering.labels_  # ✅ This is the correct way to get clusters
+if mode != "Clusters":
+    # The other maps replace the clusters map, and with it the layers it holds
+    st.session_state.pop("layer_sync", None)
+
+if mode == "Season playback":
+    # Frames are built once per workbook version; playing them is pure JS
+    st_folium(pipeline.playback_map(file_path, version, playback.SPAN), width=1200, height=800, returned_objects=[])
+elif mode == "Filter in the browser":
+    # Filtering happens in the map's own control, so map events need not rerun the script
+    m = pipeline.filter_map(file_path, version)
+    with profiling.measure("st_folium"):
+        st_folium(m, width=1200, height=800, returned_objects=[])
 else:
-    df_filtered.loc[:, "cluster"] = np.zeros(len(df_filtered), dtype=int)  # Assign every point to one cluster if too few data points exist
-
-
-# Ensure "cluster" column exists before filtering
-if "cluster" not in df_filtered.columns:
-    df_filtered["cluster"] = 0  # Assign all points to one cluster to prevent errors
-
-# Now it's safe to filter
-df_filtered = df_filtered[df_filtered["cluster"] != -1]
-
-
-# Convert to GeoDataFrame
-gdf = gpd.GeoDataFrame(df_filtered, geometry=gpd.points_from_xy(df_filtered.lon, df_filtered.lat))
-
-# Create a dict to store polygons and dominant traveler type:
-polygons = []
-for cluster in df_filtered["cluster"].unique():
-    cluster_points = gdf[gdf["cluster"] == cluster]
-
-    if len(cluster_points) < 3:
-        continue  # Skip clusters with too few points
-
-    hull = MultiPoint(cluster_points.geometry.tolist()).convex_hull.buffer(0.05)
-
-    if hull.geom_type == "Polygon":
-        polygons.append({"polygon": hull, "traveler_type": cluster_points["PrimaryActivity"].mode()[0]})
-
-    elif hull.geom_type == "LineString":  
-        polygons.append({"polygon": hull.buffer(0.001), "traveler_type": cluster_points["PrimaryActivity"].mode()[0]})
-
-    elif hull.geom_type == "Point":
-        polygons.append({"polygon": hull.buffer(0.002), "traveler_type": cluster_points["PrimaryActivity"].mode()[0]})
-
-        
-
-# The Map Making Section:
-m = folium.Map(location=[39.5,-105.5],zoom_start=7)
-
-# Plot the polygons:
-for poly in polygons:
-    folium.Polygon(
-        locations=[(point[1], point[0]) for point in list(poly["polygon"].exterior.coords)],
-        color=colordict.get(poly["traveler_type"], "gray"),  # Keeps the outline color
-        fill=True,  # Enables fill
-        fill_color=colordict.get(poly["traveler_type"], "gray"),  # Uses the same transparent fill color
-        fill_opacity=0.5,  # Adjust transparency (0 = fully transparent, 1 = solid color)
-        weight=2,  # Outline thickness
-        interactive=True,  # ✅ Makes entire polygon clickable
-        popup=folium.Popup(
-            f"<b>Most at risk:</b> {poly['traveler_type']}<br>"
-            f"<b>Incidents:</b> {len(df_filtered[df_filtered['cluster'] == cluster])}",
-            max_width=300
-        )
-    ).add_to(m)
-
-
-# Add individual points to the map as clusters:
-marker_cluster = MarkerCluster(disableClusteringAtZoom=10).add_to(m)
-
-# Plot the incidents:
-for _, row in df_filtered.iterrows():
-    folium.Marker(
-        location=[row["lat"],row["lon"]],
-        radius=5,
-        popup=f"Traveler: {row['PrimaryActivity']}<br>Location: {row['Location']}<br>Date: {row['YYYY']}-{row['MM']}-{row['DD']}",
-        color=colordict.get(row["PrimaryActivity"],"gray"),
-        fill=True,
-        fill_color=colordict.get(row["PrimaryActivity"],"gray")
-    ).add_to(marker_cluster)
-
-
-
-# Heatmap Stuff:
-
-# Weight heatmap points based on accident density
-heat_data = df_filtered[['lat', 'lon']].dropna()
-heat_data = heat_data.groupby(["lat", "lon"]).size().reset_index(name="count")
-
-# Apply weighting to the heatmap intensity
-heatmap_data = heat_data[['lat', 'lon', 'count']].values.tolist()
-
-# Add weighted heatmap
-HeatMap(heatmap_data, radius=10, blur=15, max_zoom=8).add_to(m)
-
-
-# Save the Map:
-st_folium(m, width=1200, height=800)
+    # Sidebar filter for activity types
+    traveler_filter = st.sidebar.multiselect(
+        "Filter by Traveler Type", list(df["PrimaryActivity"].unique()), default=list(df["PrimaryActivity"].unique())
+    )
+    types = pipeline.types_key(traveler_filter)
+
+    # Time filter; each window is clustered once and memoized, so scrubbing
+    # back over seasons already seen is instant
+    first, last = pipeline.season_index(file_path, version).season_range()
+    window = None
+    if first is not None:
+        span = st.sidebar.radio("Seasons", ["All", "Decade", "Range"], horizontal=True,
+                                help="Season 2024 runs from October 2023 through September 2024")
+        if span == "Decade":
+            decades = list(range(first // 10 * 10, last + 1, 10))
+            decade = st.sidebar.selectbox("Decade", decades, index=len(decades) - 1, format_func="{}s".format)
+            window = TimeWindow.decade(decade)
+        elif span == "Range":
+            seasons = st.sidebar.select_slider("Season range", options=list(range(first, last + 1)),
+                                               value=(first, last), format_func=season_label)
+            window = TimeWindow(*seasons)
+        months = st.sidebar.select_slider("Months", options=MONTH_NAMES, value=(MONTH_NAMES[0], MONTH_NAMES[-1]))
+        if months != (MONTH_NAMES[0], MONTH_NAMES[-1]):
+            first_month, last_month = ((FIRST_MONTH - 1 + MONTH_NAMES.index(m)) % 12 + 1 for m in months)
+            window = (window or TimeWindow(first, last))._replace(first_month=first_month, last_month=last_month)
+
+    # DBSCAN parameters; the first change builds the selection's neighbour
+    # graph, after which every radius and minimum is a cheap relabelling
+    radius = st.sidebar.select_slider("Cluster radius (miles)", options=pipeline.SWEEP_RADII_MILES, value=7)
+    min_samples = st.sidebar.select_slider("Incidents per cluster core", options=pipeline.SWEEP_MIN_SAMPLES,
+                                           value=pipeline.MIN_SAMPLES,
+                                           help="Neighbours (itself included) an incident needs to seed a cluster")
+    eps = radius / pipeline.EARTH_RADIUS_MILES
+    with st.sidebar.expander("Parameter sweep"):
+        if st.checkbox("Compare every radius and minimum"):
+            st.dataframe(pipeline.sweep(file_path, version, types, window), hide_index=True)
+
+    # The Map Making Section: the base map never changes, so the browser
+    # keeps it (and the viewport) and only receives the layers it lacks,
+    # incident markers as the precomputed aggregates of the current zoom
+    zoom = int((st.session_state.get("clusters_map") or {}).get("zoom") or START_ZOOM)
+    items = pipeline.map_items(file_path, version, types, window, eps, min_samples, zoom)
+    sync = st.session_state.setdefault("layer_sync", LayerSync())
+    with profiling.measure("build_map"):
+        layers = sync.layer(items)
+    with profiling.measure("st_folium"):
+        # Only clicks and zooming rerun the script; clicks feed the nearby lookup below
+        state = st_folium(base_map(), key="clusters_map", feature_group_to_add=layers,
+                          width=1200, height=800, returned_objects=["last_clicked", "zoom"])
+    if sync.lost(state):
+        # The map was remounted and lost its layers: send everything again
+        sync.reset()
+        st.rerun()
+
+    clicked = (state or {}).get("last_clicked")
+    with st.sidebar.expander("Incidents near a point", expanded=clicked is not None):
+        st.caption("Click the map or enter coordinates")
+        lat = st.number_input("Latitude", value=clicked["lat"] if clicked else 39.5, format="%.4f")
+        lon = st.number_input("Longitude", value=clicked["lng"] if clicked else -105.5, format="%.4f")
+        near_radius = st.slider("Within (miles)", 1, 25, 5)
+        found, zones = pipeline.near(file_path, version, lat, lon, near_radius, types, window, eps, min_samples)
+        if len(zones):
+            for zone in zones.itertuples():
+                st.write(f"Inside a cluster zone of {zone.count} incidents, mostly {zone.traveler_type or 'unassigned'}")
+        else:
+            st.write("Not inside a cluster zone")
+        st.write(f"{len(found)} incidents within {near_radius} miles")
+        st.dataframe(found[["YYYY", "MM", "Location", "PrimaryActivity", "distance_miles"]].round({"distance_miles": 1}),
+                     hide_index=True)
+
+    with st.sidebar.expander("Score a track"):
+        upload = st.file_uploader("GPX or GeoJSON track", type=["gpx", "geojson", "json"])
+        track_radius = st.slider("Nearby within (miles)", 0.25, 5.0, 1.0, step=0.25)
+        if upload is not None:
+            try:
+                track = tracks.read_track(upload.getvalue())
+            except ValueError as error:
+                st.error(str(error))
+            else:
+                score = pipeline.score_track(file_path, version, track, track_radius, types, window, eps, min_samples)
+                st.write(f"{score.length_miles:,.1f} miles, {len(score.zones)} cluster zones crossed, "
+                         f"{len(score.nearby)} incidents within {track_radius:g} miles")
+                st.dataframe(score.zones[["count", "traveler_type", "miles_in_zone"]].round(2), hide_index=True)
+
+with st.sidebar.expander("Debug"):
+    st.caption("Pipeline stage cache")
+    st.dataframe(pipeline.stage_stats())
+    st.caption(f"Incident frame: {pipeline.frame_bytes(df) / 1024:,.0f} kB for {len(df):,} incidents")
+
+    # Process-wide; tracing allocations slows every session while it is on
+    profile = st.checkbox("Profile stages", value=profiling.enabled(),
+                          help="Record wall time, CPU time and peak allocation of each stage that runs")
+    if profile and not profiling.enabled():
+        profiling.enable()
+    elif not profile and profiling.enabled():
+        profiling.disable()
+    if profile:
+        st.caption("Stages computed since profiling started (cache hits are not listed)")
+        st.dataframe(profiling.records_frame().iloc[::-1], hide_index=True)
+        st.download_button("Download JSON", profiling.records_json(), "stage_profile.json", "application/json")
 
 st.markdown("""
 ### Forecast Zone Risk Legend:
@@ -218,7 +151,3 @@ represent the modes of travel used by the victim(s) of these incidents caught in
 The goal of this map is to determine which mode of travel, historically, is most likely to be caught in avalanches
 in the zones seen.
 """)
-
-
-#print(df_filtered[['lat', 'lon']].dropna())  # Show all non-null lat/lon values
-
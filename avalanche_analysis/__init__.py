@@ -0,0 +1 @@
+"""Data pipeline behind the Colorado avalanche Streamlit app (avalanche.py)."""
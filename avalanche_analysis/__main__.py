@@ -0,0 +1,155 @@
+"""Command line entry point; none of these commands import streamlit.
+
+    python -m avalanche_analysis build --out map.html --types skier,hiker
+    python -m avalanche_analysis build --out map.html --client-filter
+    python -m avalanche_analysis build --out playback.html --playback
+    python -m avalanche_analysis tiles --out incidents.pmtiles --maxzoom 12
+    python -m avalanche_analysis precompute
+    python -m avalanche_analysis serve --port 8765
+    python -m avalanche_analysis score route.gpx --radius 1
+    python -m avalanche_analysis bench clustering
+    python -m avalanche_analysis bench stages --out bench.json
+"""
+import argparse
+import importlib.util
+import os
+import sys
+
+from avalanche_analysis import bench, pipeline, playback, precompute, server, tiles, tracks
+from avalanche_analysis.clustering import ENGINES
+from avalanche_analysis.render import COMPRESSORS, build_filter_map, build_map, incident_details, write_json, write_map
+
+DEFAULT_WORKBOOK = "CAIC_Accident_Data_Nov_2024.xlsx"
+
+
+def build(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m avalanche_analysis build",
+                                     description="Write the traveler-type map as standalone HTML.")
+    parser.add_argument("--workbook", default=DEFAULT_WORKBOOK)
+    parser.add_argument("--out", default="avalanche_traveler_map.html")
+    parser.add_argument("--types", default=None,
+                        help="comma separated traveler types (default: all), e.g. skier,hiker")
+    parser.add_argument("--compress", nargs="*", default=[], choices=sorted(COMPRESSORS),
+                        help="also write pre-compressed copies next to --out")
+    parser.add_argument("--client-filter", action="store_true",
+                        help="ship every traveler-type subset and filter in the browser (ignores --types)")
+    parser.add_argument("--playback", action="store_true",
+                        help="animate the clusters season by season (ignores --types)")
+    parser.add_argument("--inline-details", action="store_true",
+                        help="embed the marker popup details instead of writing them to a .details.json file "
+                             "next to --out (browsers do not fetch it for pages opened from disk)")
+    parser.add_argument("--engine", default="grid", choices=sorted(ENGINES),
+                        help="clustering engine; 'projected' is approximate")
+    parser.add_argument("--no-minify", action="store_true")
+    args = parser.parse_args(argv)
+    if "brotli" in args.compress and importlib.util.find_spec("brotli") is None:
+        parser.error("--compress brotli needs the 'brotli' package (pip install brotli)")
+
+    version = pipeline.source_version(args.workbook)
+    df = pipeline.normalize(args.workbook, version)
+    types = _types(parser, args.types, df)
+    # Popup details go to a side file the page fetches on the first click
+    details_path = os.path.splitext(args.out)[0] + ".details.json"
+    details_url = None if args.inline_details or args.playback else os.path.basename(details_path)
+    if args.playback:
+        m = playback.playback_map(df)
+    elif args.client_filter:
+        mapped = df
+        m = build_filter_map(df, *precompute.cluster_subsets(df), details_url)
+    else:
+        selection = (args.workbook, version, types, None, pipeline.EPS_DISTANCE, pipeline.MIN_SAMPLES, args.engine)
+        mapped = pipeline.cluster(*selection)
+        m = build_map(mapped, pipeline.hulls(*selection), details_url=details_url)
+    written = write_map(m, args.out, minify=not args.no_minify, compress=args.compress)
+    if details_url is not None:
+        written += write_json(incident_details(mapped), details_path, compress=args.compress)
+    for path in written:
+        print(f"{path}: {os.path.getsize(path) / 1024:,.0f} kB")
+
+
+def export_tiles(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m avalanche_analysis tiles",
+                                     description="Write incidents and cluster hulls as a vector tile archive.")
+    parser.add_argument("--workbook", default=DEFAULT_WORKBOOK)
+    parser.add_argument("--out", default="avalanche_incidents.pmtiles",
+                        help=f"archive path; the suffix picks the format ({', '.join(tiles.ARCHIVES)})")
+    parser.add_argument("--types", default=None,
+                        help="comma separated traveler types (default: all), e.g. skier,hiker")
+    parser.add_argument("--minzoom", type=int, default=0)
+    parser.add_argument("--maxzoom", type=int, default=12)
+    parser.add_argument("--engine", default="grid", choices=sorted(ENGINES),
+                        help="clustering engine; 'projected' is approximate")
+    args = parser.parse_args(argv)
+    if os.path.splitext(args.out)[1].lower() not in tiles.ARCHIVES:
+        parser.error(f"--out must end in one of {', '.join(tiles.ARCHIVES)}")
+    if not 0 <= args.minzoom <= args.maxzoom <= 22:
+        parser.error("need 0 <= --minzoom <= --maxzoom <= 22")
+
+    version = pipeline.source_version(args.workbook)
+    types = _types(parser, args.types, pipeline.normalize(args.workbook, version))
+    selection = (args.workbook, version, types, None, pipeline.EPS_DISTANCE, pipeline.MIN_SAMPLES, args.engine)
+    count = tiles.write_tiles(pipeline.cluster(*selection), pipeline.hulls(*selection),
+                              args.out, args.minzoom, args.maxzoom)
+    print(f"{args.out}: {count:,} tiles, {os.path.getsize(args.out) / 1024:,.0f} kB")
+
+
+def score(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m avalanche_analysis score",
+                                     description="Score a GPX or GeoJSON track against the cluster zones.")
+    parser.add_argument("track", help="GPX or GeoJSON file")
+    parser.add_argument("--workbook", default=DEFAULT_WORKBOOK)
+    parser.add_argument("--radius", type=float, default=1, help="miles from the track counted as nearby")
+    parser.add_argument("--types", default=None,
+                        help="comma separated traveler types (default: all), e.g. skier,hiker")
+    args = parser.parse_args(argv)
+
+    with open(args.track, "rb") as f:
+        try:
+            track = tracks.read_track(f.read())
+        except ValueError as error:
+            parser.error(f"{args.track}: {error}")
+    version = pipeline.source_version(args.workbook)
+    types = _types(parser, args.types, pipeline.normalize(args.workbook, version))
+    result = pipeline.score_track(args.workbook, version, track, args.radius, types)
+
+    print(f"{result.length_miles:,.1f} miles, {len(result.zones)} cluster zones crossed")
+    if len(result.zones):
+        print(result.zones[["cluster", "count", "traveler_type", "miles_in_zone"]].round(2).to_string(index=False))
+    print(f"{len(result.nearby)} incidents within {args.radius:g} miles")
+    if len(result.nearby):
+        counts = result.nearby["PrimaryActivity"].value_counts(dropna=False)
+        print(counts[counts > 0].to_string())
+
+
+def _types(parser, option, df):
+    """Traveler-type key for a ``--types`` option (all types when unset)."""
+    if not option:
+        return pipeline.types_key(df["PrimaryActivity"].unique())
+    types = pipeline.types_key(t.strip() for t in option.split(","))
+    unknown = set(types) - set(pipeline.TRAVELER_TYPES)
+    if unknown:
+        parser.error(f"unknown traveler types: {', '.join(sorted(unknown))} "
+                     f"(choose from {', '.join(pipeline.TRAVELER_TYPES)})")
+    return types
+
+
+COMMANDS = {
+    "build": build,
+    "tiles": export_tiles,
+    "precompute": precompute.main,
+    "bench": bench.main,
+    "serve": server.main,
+    "score": score,
+}
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv or argv[0] not in COMMANDS:
+        print(__doc__.strip(), file=sys.stderr)
+        return 2
+    return COMMANDS[argv[0]](argv[1:]) or 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
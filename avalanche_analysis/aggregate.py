@@ -0,0 +1,67 @@
+"""Zoom-level hierarchy of incident aggregates, in the style of supercluster.
+
+``MarkerCluster`` has Leaflet.markercluster cluster every marker in the
+browser, again on each zoom.  Here the hierarchy is built once per selection
+with NumPy: at the finest clustered zoom the incidents are binned into square
+cells of :data:`CELL_PIXELS` screen pixels in Web Mercator space, and each
+coarser level merges the cells of the level below it (a cell at zoom ``z`` is
+exactly four cells at ``z + 1``), summing counts and positions.  From
+:data:`MAX_ZOOM` on every incident is drawn on its own, so a map only needs
+the aggregates of the zoom it shows.
+"""
+from typing import NamedTuple
+
+import numpy as np
+
+from avalanche_analysis import tiles
+
+# Cell size on screen; Leaflet.markercluster merges markers within 80 px
+CELL_PIXELS = 60
+
+# First zoom without aggregation (the maps' former disableClusteringAtZoom)
+MAX_ZOOM = 10
+
+TILE_PIXELS = 256
+
+
+class ZoomLevel(NamedTuple):
+    """The aggregates of one zoom: mean position, incident count, the zoom at
+    which each one splits up, and for single incidents their position in the
+    input (-1 for aggregates of several)."""
+    lat: np.ndarray
+    lon: np.ndarray
+    count: np.ndarray
+    expansion: np.ndarray
+    row: np.ndarray
+
+
+def zoom_levels(lat, lon, max_zoom=MAX_ZOOM, cell_pixels=CELL_PIXELS):
+    """:class:`ZoomLevel` of each zoom ``0 .. max_zoom - 1`` for the points
+    ``(lat, lon)`` in degrees."""
+    lat = np.asarray(lat, dtype=np.float64)
+    lon = np.asarray(lon, dtype=np.float64)
+    x, y = tiles.mercator(lon, lat)
+    # Cells of the finest level; coarser cells are these shifted right, as
+    # floor(floor(2a) / 2) == floor(a)
+    finest = max_zoom - 1
+    scale = (TILE_PIXELS << finest) / cell_pixels
+    cx = np.floor(x * scale).astype(np.int64)
+    cy = np.floor(y * scale).astype(np.int64)
+
+    # Level max_zoom: every point on its own
+    count = np.ones(len(lat), dtype=np.int64)
+    lat_sum, lon_sum = lat, lon
+    expansion = np.full(len(lat), max_zoom, dtype=np.int64)
+    row = np.arange(len(lat), dtype=np.int64)
+    levels = []
+    for zoom in range(finest, -1, -1):
+        shift = finest - zoom
+        _, first, inverse = np.unique(((cx >> shift) << 32) | (cy >> shift), return_index=True, return_inverse=True)
+        children = np.bincount(inverse)
+        count = np.bincount(inverse, count).astype(np.int64)
+        lat_sum, lon_sum = np.bincount(inverse, lat_sum), np.bincount(inverse, lon_sum)
+        expansion = np.where(children > 1, zoom + 1, expansion[first])
+        row = np.where(count == 1, row[first], -1)
+        cx, cy = cx[first], cy[first]
+        levels.append(ZoomLevel(lat_sum / count, lon_sum / count, count, expansion, row))
+    return levels[::-1]
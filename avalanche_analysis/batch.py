@@ -0,0 +1,144 @@
+"""Batch clustering over a process pool with shared coordinates.
+
+Building the subset artifact, the playback frames or a parameter sweep means
+many independent DBSCAN + hull runs over slices of the same incidents.
+:func:`cluster_jobs` fans them out over a ``ProcessPoolExecutor``: the
+columns the jobs need (coordinates, traveler-type codes and season keys) are
+copied once into a ``multiprocessing.shared_memory`` block that every worker
+maps, and a job only carries its selection (traveler types, season window)
+and DBSCAN parameters.  Workers send back labels and hulls, not frames.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import NamedTuple, Optional
+
+import numpy as np
+import pandas as pd
+
+from avalanche_analysis import pipeline, seasons
+
+# Below this many selected incidents in total, starting worker processes
+# costs more than it saves
+POOL_MIN_ROWS = 100_000
+
+
+class ClusterJob(NamedTuple):
+    """One clustering: incidents of ``types`` (None for all) in ``window``.
+
+    ``eps`` and ``min_samples`` default to the pipeline's parameters.
+    """
+    types: Optional[tuple] = None
+    window: Optional[seasons.TimeWindow] = None
+    eps: Optional[float] = None
+    min_samples: Optional[int] = None
+
+
+class JobResult(NamedTuple):
+    """``rows``: positions of the selected incidents in the frame; ``labels``:
+    their DBSCAN labels (-1 for noise); ``hulls``: :func:`pipeline.build_hulls`."""
+    rows: np.ndarray
+    labels: np.ndarray
+    hulls: object
+
+
+def job_columns(df):
+    """The arrays a job reads, as contiguous numpy columns of ``df``."""
+    return {
+        "lat": df["lat"].to_numpy(),
+        "lon": df["lon"].to_numpy(),
+        "type": df["PrimaryActivity"].cat.codes.to_numpy(),
+        "season": seasons.season_keys(df),
+    }
+
+
+def select_rows(columns, job):
+    """Positions of the incidents ``job`` selects, in frame order."""
+    selected = np.ones(len(columns["lat"]), dtype=bool)
+    if job.types is not None:
+        codes = [-1 if t is None else pipeline.TRAVELER_TYPES.index(t) for t in job.types]
+        selected &= np.isin(columns["type"], codes)
+    if job.window is not None:
+        selected &= seasons.in_window(columns["season"], job.window)
+    return np.flatnonzero(selected)
+
+
+def run_job(columns, job):
+    """Cluster and hull the incidents ``job`` selects from ``columns``."""
+    rows = select_rows(columns, job)
+
+    frame = pd.DataFrame({
+        "PrimaryActivity": pd.Categorical.from_codes(columns["type"][rows], categories=pipeline.TRAVELER_TYPES),
+        "lat": columns["lat"][rows],
+        "lon": columns["lon"][rows],
+    })
+    eps = pipeline.EPS_DISTANCE if job.eps is None else job.eps
+    min_samples = pipeline.MIN_SAMPLES if job.min_samples is None else job.min_samples
+    clustered = pipeline.cluster_incidents(frame, eps, min_samples)
+    labels = np.full(len(rows), -1, dtype=np.int64)
+    labels[clustered.index.to_numpy()] = clustered["cluster"].to_numpy()
+    return JobResult(rows, labels, pipeline.build_hulls(clustered))
+
+
+# Worker side: the attached block and the views into it
+_shared = None
+_columns = None
+
+
+def _attach(name, layout):
+    global _shared, _columns
+    # Spawned workers report to the parent's resource tracker, so the
+    # parent's unlink is the only cleanup needed
+    _shared = shared_memory.SharedMemory(name)
+    _columns = {
+        key: np.ndarray(shape, dtype=dtype, buffer=_shared.buf, offset=offset)
+        for key, (dtype, shape, offset) in layout.items()
+    }
+
+
+def _run(job):
+    return run_job(_columns, job)
+
+
+def _share(columns):
+    """Copy ``columns`` into a new shared block; returns it and its layout."""
+    layout, offset = {}, 0
+    for key, array in columns.items():
+        offset = -(-offset // 8) * 8
+        layout[key] = (array.dtype.str, array.shape, offset)
+        offset += array.nbytes
+    block = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+    for key, array in columns.items():
+        dtype, shape, start = layout[key]
+        np.ndarray(shape, dtype=dtype, buffer=block.buf, offset=start)[...] = array
+    return block, layout
+
+
+def cluster_jobs(df, jobs, workers=None):
+    """:class:`JobResult` for each of ``jobs`` over the normalized ``df``.
+
+    ``workers`` is the process count; by default one per CPU once the jobs
+    select :data:`POOL_MIN_ROWS` incidents in total.  With one worker the
+    jobs run in this process.  Results equal running
+    :func:`pipeline.cluster_incidents` and :func:`pipeline.build_hulls` on
+    each selection.
+    """
+    columns = job_columns(df)
+    if workers is None:
+        total = sum(len(select_rows(columns, job)) for job in jobs)
+        workers = min(os.cpu_count() or 1, len(jobs)) if total >= POOL_MIN_ROWS else 1
+    if workers <= 1 or len(jobs) <= 1:
+        return [run_job(columns, job) for job in jobs]
+
+    block, layout = _share(columns)
+    try:
+        # Spawned rather than forked: the app calls this from a server thread
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context, initializer=_attach,
+                                 initargs=(block.name, layout)) as pool:
+            return list(pool.map(_run, jobs))
+    finally:
+        block.close()
+        block.unlink()
+
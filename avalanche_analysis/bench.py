@@ -0,0 +1,329 @@
+"""Benchmarks over synthetic CAIC-shaped incident data.
+
+    python -m avalanche_analysis.bench clustering --sizes 1000 100000 1000000
+    python -m avalanche_analysis.bench projection --sizes 10000 100000
+    python -m avalanche_analysis.bench stages --out bench.json --baseline main.json
+    python -m avalanche_analysis.bench batch --workers 1 2 4 8
+    python -m avalanche_analysis.bench sweep --sizes 10000 100000
+    python -m avalanche_analysis.bench nearby --sizes 1000000 --radius 7
+    python -m avalanche_analysis.bench zoom --sizes 10000 100000
+"""
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+from sklearn.metrics import adjusted_rand_score
+
+from avalanche_analysis import aggregate, batch, clustering, heatmap, ingest, nearby, pipeline, precompute, render
+from avalanche_analysis.pipeline import EPS_DISTANCE, MIN_SAMPLES, TRAVELER_MAPPING
+
+# Western US mountain states, to mimic a multi-state dataset
+BBOX = ((31.3, 49.0), (-124.5, -102.0))
+
+
+def synthetic_incidents(n, seed=0, hotspots=None, spread=0.15):
+    """``n`` incidents with the CAIC columns, grouped around random hotspots."""
+    rng = np.random.default_rng(seed)
+    hotspots = hotspots or max(10, int(np.sqrt(n)))
+    (lat0, lat1), (lon0, lon1) = BBOX
+    centers = rng.uniform([lat0, lon0], [lat1, lon1], size=(hotspots, 2))
+    coords = centers[rng.integers(0, hotspots, n)] + rng.normal(0, spread, size=(n, 2))
+    activities = np.array([a.replace("_", " ").title() for a in TRAVELER_MAPPING])
+    return pd.DataFrame({
+        "YYYY": rng.integers(1951, 2025, n),
+        "MM": rng.integers(1, 13, n),
+        "DD": rng.integers(1, 29, n),
+        "Location": pd.Series(rng.integers(0, 5000, n)).map("Location {}".format),
+        "PrimaryActivity": activities[rng.integers(0, len(activities), n)],
+        "lat": np.clip(coords[:, 0], lat0, lat1),
+        "lon": np.clip(coords[:, 1], lon0, lon1),
+    })
+
+
+def timed(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def profiled(func, *args, repeat=1, memory=True):
+    """``(result, seconds, peak_bytes)`` for ``func(*args)``.
+
+    ``seconds`` is the best of ``repeat`` untraced runs; the peak allocation
+    comes from one extra run under ``tracemalloc``, which would otherwise
+    skew the timing.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        result, seconds = timed(func, *args)
+        best = min(best, seconds)
+    peak = None
+    if memory:
+        tracemalloc.start()
+        try:
+            func(*args)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+    return result, best, peak
+
+
+def _size(value):
+    if isinstance(value, pd.DataFrame):
+        return len(value)
+    if isinstance(value, (list, str)):
+        return len(value)
+    return None
+
+
+def bench_stages(sizes, excel_limit=None, repeat=1, memory=True, seed=0, workdir=None):
+    """Time and memory-profile each stage of the map pipeline on its own.
+
+    Every stage is fed the previous stage's output, so it runs on realistic
+    input: Excel parsing, the Arrow snapshot round trip, normalization,
+    DBSCAN, hulls, marker rows, the density image, map assembly and the HTML
+    serialization ``st_folium`` performs.  Excel is skipped above
+    ``excel_limit`` incidents (writing the fixture alone takes minutes);
+    normalization then starts from the synthetic frame.
+    """
+    rows = []
+    with tempfile.TemporaryDirectory(dir=workdir) as tmp:
+        for n in sizes:
+            def run(name, func, *args):
+                result, seconds, peak = profiled(func, *args, repeat=repeat, memory=memory)
+                rows.append({"n": n, "stage": name, "seconds": seconds, "peak_bytes": peak, "size": _size(result)})
+                return result
+
+            raw = synthetic_incidents(n, seed)
+            if excel_limit is None or n <= excel_limit:
+                workbook = os.path.join(tmp, f"incidents_{n}.xlsx")
+                raw.to_excel(workbook, index=False)
+                raw = run("excel", ingest.read_workbook, workbook)
+            snapshot = os.path.join(tmp, f"incidents_{n}.arrow")
+            run("snapshot_write", ingest.write_snapshot, raw, snapshot)
+            run("snapshot_read", ingest.read_snapshot, snapshot, pipeline.INCIDENT_COLUMNS)
+            df = run("normalize", pipeline.normalize_incidents, raw)
+            clustered = run("cluster", pipeline.cluster_incidents, df)
+            hulls = run("hulls", pipeline.build_hulls, clustered)
+            run("markers", render.incident_rows, clustered)
+            image = run("heatmap", heatmap.density_image, clustered)
+            m = run("map", render.build_map, clustered, hulls, image)
+            run("serialize", lambda: m.get_root().render())
+    return pd.DataFrame(rows).astype({"size": "Int64"})
+
+
+def bench_metadata():
+    return {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "numpy": np.__version__,
+        "pandas": pd.__version__,
+    }
+
+
+def write_results(results, out, **meta):
+    """Write ``results`` and run metadata to ``out`` as JSON."""
+    payload = {"meta": {**bench_metadata(), **meta},
+               "results": json.loads(results.to_json(orient="records"))}
+    with open(out, "w") as f:
+        json.dump(payload, f, indent=1)
+
+
+def regressions(results, baseline, tolerance=1.25, min_seconds=0.05):
+    """Stages at least ``tolerance`` times slower (or hungrier) than ``baseline``.
+
+    ``baseline`` is a file written by :func:`write_results`; stages faster
+    than ``min_seconds`` in both runs are too noisy to compare on time.
+    """
+    with open(baseline) as f:
+        before = pd.DataFrame(json.load(f)["results"])
+    merged = results.merge(before, on=["n", "stage"], suffixes=("", "_baseline"))
+    slower = ((merged["seconds"] > tolerance * merged["seconds_baseline"])
+              & (merged[["seconds", "seconds_baseline"]].max(axis=1) >= min_seconds))
+    hungrier = merged["peak_bytes"] > tolerance * merged["peak_bytes_baseline"]
+    return merged[slower | hungrier.fillna(False)]
+
+
+def bench_clustering(sizes, engines=("grid", "sklearn"), sklearn_limit=None, seed=0):
+    """Time each clustering engine per size and check they agree."""
+    rows = []
+    for n in sizes:
+        coords = np.radians(synthetic_incidents(n, seed)[["lat", "lon"]].to_numpy())
+        labels = {}
+        for engine in engines:
+            if engine == "sklearn" and sklearn_limit and n > sklearn_limit:
+                continue
+            labels[engine], seconds = timed(clustering.ENGINES[engine], coords, EPS_DISTANCE, MIN_SAMPLES)
+            rows.append({"n": n, "engine": engine, "seconds": seconds,
+                         "clusters": int(labels[engine].max()) + 1})
+        if len(labels) > 1:
+            reference = next(iter(labels.values()))
+            for row in rows[-len(labels):]:
+                row["matches"] = bool((labels[row["engine"]] == reference).all())
+    return pd.DataFrame(rows)
+
+
+def projection_error(reference, labels):
+    """How far projected labels are from the haversine ones."""
+    return {
+        "ari": adjusted_rand_score(reference, labels),
+        "noise_flips": float(((reference == -1) != (labels == -1)).mean()),
+        "cluster_delta": int(labels.max()) - int(reference.max()),
+    }
+
+
+def bench_projection(sizes, seed=0, crs=None):
+    """Time the projected engine against grid DBSCAN and report its error.
+
+    Projecting is timed separately: the app caches the projected coordinates
+    per workbook (``pipeline.projected``), so only the clustering is paid per
+    filter change.
+    """
+    rows = []
+    for n in sizes:
+        coords = np.radians(synthetic_incidents(n, seed)[["lat", "lon"]].to_numpy())
+        reference, grid_seconds = timed(clustering.grid_dbscan, coords, EPS_DISTANCE, MIN_SAMPLES)
+        xy, project_seconds = timed(clustering.project, coords, crs)
+        labels, seconds = timed(clustering.projected_dbscan, coords, EPS_DISTANCE, MIN_SAMPLES, xy=xy)
+        rows.append({"n": n, "grid_seconds": grid_seconds, "project_seconds": project_seconds,
+                     "projected_seconds": seconds, **projection_error(reference, labels)})
+    return pd.DataFrame(rows)
+
+
+def bench_batch(n, workers, seed=0):
+    """Time the traveler-type subset batch for each worker count."""
+    df = pipeline.normalize_incidents(synthetic_incidents(n, seed))
+    jobs = [batch.ClusterJob(types) for types in precompute.all_subsets(df)]
+    rows = []
+    for count in workers:
+        _, seconds = timed(batch.cluster_jobs, df, jobs, count)
+        rows.append({"n": n, "jobs": len(jobs), "workers": count, "seconds": seconds})
+    results = pd.DataFrame(rows)
+    results["speedup"] = results["seconds"].iloc[0] / results["seconds"]
+    return results
+
+
+def bench_sweep(sizes, seed=0):
+    """One neighbour graph plus relabelling vs a fresh DBSCAN per parameter pair."""
+    combos = [(miles / pipeline.EARTH_RADIUS_MILES, minimum)
+              for miles in pipeline.SWEEP_RADII_MILES for minimum in pipeline.SWEEP_MIN_SAMPLES]
+    rows = []
+    for n in sizes:
+        coords = np.radians(synthetic_incidents(n, seed)[["lat", "lon"]].to_numpy())
+        graph, build = timed(clustering.NeighborGraph, coords, pipeline.SWEEP_MAX_EPS)
+        swept, relabel = timed(lambda: [graph.labels(eps, minimum) for eps, minimum in combos])
+        fresh, rerun = timed(lambda: [clustering.grid_dbscan(coords, eps, minimum) for eps, minimum in combos])
+        rows.append({"n": n, "combinations": len(combos), "pairs": len(graph.a), "graph_seconds": build,
+                     "relabel_seconds": relabel, "rerun_seconds": rerun,
+                     "matches": all(np.array_equal(a, b) for a, b in zip(swept, fresh))})
+    return pd.DataFrame(rows)
+
+
+def bench_nearby(sizes, radius_miles=7, queries=1000, seed=0):
+    """Build and open the incident R-tree, then time radius lookups around
+    random incidents."""
+    rows = []
+    for n in sizes:
+        df = pipeline.normalize_incidents(synthetic_incidents(n, seed))
+        with tempfile.TemporaryDirectory() as workdir:
+            base = os.path.join(workdir, "incidents")
+            _, build = timed(nearby.build_index, base, df)
+            index, load = timed(nearby.IncidentIndex, base, df)
+            points = df[["lat", "lon"]].sample(queries, replace=True, random_state=seed).to_numpy(dtype=np.float64)
+            seconds, found = [], 0
+            for lat, lon in points:
+                (hits, _), elapsed = timed(index.within, lat, lon, radius_miles)
+                seconds.append(elapsed)
+                found += len(hits)
+            index.close()
+        rows.append({"n": n, "radius_miles": radius_miles, "build_seconds": build, "open_seconds": load,
+                     "median_ms": np.median(seconds) * 1e3, "p99_ms": np.percentile(seconds, 99) * 1e3,
+                     "mean_hits": found / queries})
+    return pd.DataFrame(rows)
+
+
+def bench_zoom(sizes, seed=0):
+    """Build the per-zoom aggregates and compare the markers a map draws at
+    the start zoom with drawing every incident."""
+    rows = []
+    for n in sizes:
+        df = synthetic_incidents(n, seed)
+        levels, build = timed(aggregate.zoom_levels, df["lat"], df["lon"])
+        payloads, encode = timed(render.zoom_payloads, df, np.arange(n))
+        start = payloads[render.START_ZOOM]
+        rows.append({"n": n, "levels_seconds": build, "payload_seconds": encode,
+                     "start_zoom_markers": len(start["clusters"]) + len(start["singles"]),
+                     "start_zoom_kB": len(json.dumps(start)) / 1024,
+                     "all_markers_kB": len(json.dumps(payloads[-1])) / 1024,
+                     "largest_level": max(len(level.count) for level in levels)})
+    return pd.DataFrame(rows)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    sub = parser.add_subparsers(dest="suite", required=True)
+    cl = sub.add_parser("clustering", help="grid vs sklearn DBSCAN")
+    cl.add_argument("--sizes", type=int, nargs="+", default=[1_000, 100_000, 1_000_000])
+    cl.add_argument("--engines", nargs="+", default=["grid", "sklearn"], choices=sorted(clustering.ENGINES))
+    cl.add_argument("--sklearn-limit", type=int, default=200_000,
+                    help="skip sklearn above this many incidents (its neighbourhoods do not fit in memory)")
+    pr = sub.add_parser("projection", help="projected KD-tree vs haversine DBSCAN: speed and label error")
+    pr.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000])
+    pr.add_argument("--crs", help="target CRS (default: the UTM zone of the data)")
+    st = sub.add_parser("stages", help="time and memory per pipeline stage")
+    st.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    st.add_argument("--excel-limit", type=int, default=100_000,
+                    help="skip the Excel stage above this many incidents")
+    st.add_argument("--repeat", type=int, default=1, help="report the best of this many runs")
+    st.add_argument("--no-memory", action="store_true", help="skip the tracemalloc pass")
+    st.add_argument("--out", help="write the results as JSON")
+    st.add_argument("--baseline", help="JSON from an earlier run; exit 1 on regressions")
+    st.add_argument("--tolerance", type=float, default=1.25)
+    ba = sub.add_parser("batch", help="process-pool scaling of the subset batch")
+    ba.add_argument("--size", type=int, default=100_000)
+    ba.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4, os.cpu_count() or 1])
+    sw = sub.add_parser("sweep", help="eps/min_samples sweep over one neighbour graph vs re-clustering")
+    sw.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 50_000])
+    ne = sub.add_parser("nearby", help="R-tree build time and radius lookup latency")
+    ne.add_argument("--sizes", type=int, nargs="+", default=[10_000, 1_000_000])
+    ne.add_argument("--radius", type=float, default=7)
+    zo = sub.add_parser("zoom", help="per-zoom aggregate hierarchy: build time and markers per zoom")
+    zo.add_argument("--sizes", type=int, nargs="+", default=[1_000, 10_000, 100_000, 1_000_000])
+    args = parser.parse_args(argv)
+
+    if args.suite == "stages":
+        results = bench_stages(args.sizes, args.excel_limit, args.repeat, not args.no_memory)
+        print(results.to_string(index=False))
+        if args.out:
+            write_results(results, args.out, repeat=args.repeat)
+        if args.baseline:
+            slower = regressions(results, args.baseline, args.tolerance)
+            if not slower.empty:
+                print(f"\nRegressions against {args.baseline}:")
+                print(slower.to_string(index=False))
+                return 1
+    elif args.suite == "clustering":
+        print(bench_clustering(args.sizes, args.engines, args.sklearn_limit).to_string(index=False))
+    elif args.suite == "zoom":
+        print(bench_zoom(args.sizes).to_string(index=False))
+    elif args.suite == "nearby":
+        print(bench_nearby(args.sizes, args.radius).to_string(index=False))
+    elif args.suite == "sweep":
+        print(bench_sweep(args.sizes).to_string(index=False))
+    elif args.suite == "batch":
+        print(bench_batch(args.size, sorted(set(args.workers))).to_string(index=False))
+    elif args.suite == "projection":
+        print(bench_projection(args.sizes, crs=args.crs).to_string(index=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
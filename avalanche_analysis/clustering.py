@@ -0,0 +1,356 @@
+"""Clustering engines for haversine DBSCAN over incident coordinates.
+
+``grid_dbscan`` is a drop-in replacement for
+``DBSCAN(metric="haversine").fit(coords).labels_`` specialised for a fixed,
+small eps: points are bucketed into eps-sized lat/lon cells and distances
+are only computed between neighbouring cells, in bounded blocks.  Labels match
+sklearn's exactly, including its numbering (clusters in order of their lowest
+core point) and the assignment of border points reachable from two clusters
+(they join the lower-numbered one).
+
+``projected_dbscan`` trades that exactness for speed: it projects once to a
+local metric CRS and finds neighbours with a KD-tree.
+
+``NeighborGraph`` serves parameter sweeps: one neighbour search at the
+largest eps, after which the labels for any smaller eps and any min_samples
+are a relabelling of a prefix of its (distance-sorted) pairs.
+
+Coordinates are ``(lat, lon)`` in radians throughout, as for sklearn.
+"""
+from functools import lru_cache
+
+import numpy as np
+from pyproj import Transformer
+from scipy.sparse import coo_matrix, csr_matrix
+from scipy.sparse.csgraph import connected_components
+from scipy.spatial import cKDTree
+from sklearn.cluster import DBSCAN
+from sklearn.neighbors import BallTree
+
+# Upper bound on the number of pairwise distances evaluated at once
+BLOCK_SIZE = 1 << 22
+
+# Neighbour pairs found by the first pass are kept for the later passes up to
+# this many; denser inputs recompute distances instead of holding them.
+MAX_CACHED_PAIRS = 1 << 25
+
+# Mean earth radius matching the 3958.8 miles behind pipeline.EPS_DISTANCE
+EARTH_RADIUS_M = 3958.8 * 1609.344
+
+# Forward half of the 3x3 cell neighbourhood; the other half is covered by
+# symmetry when the neighbour cell visits us.
+_FORWARD = ((0, 0), (0, 1), (1, -1), (1, 0), (1, 1))
+
+
+def sklearn_dbscan(coords, eps, min_samples):
+    """The reference path: sklearn's ball-tree DBSCAN."""
+    return DBSCAN(eps=eps, min_samples=min_samples, metric="haversine").fit(coords).labels_
+
+
+def _rdist(lat_a, lon_a, cos_a, lat_b, lon_b, cos_b):
+    # Same reduced haversine distance, in the same operation order, as
+    # sklearn's HaversineDistance.rdist
+    sin_0 = np.sin(0.5 * (lat_a - lat_b))
+    sin_1 = np.sin(0.5 * (lon_a - lon_b))
+    return sin_0 * sin_0 + cos_a * cos_b * sin_1 * sin_1
+
+
+class _Grid:
+    """Points sorted into eps-sized cells, and the candidate pairs between
+    neighbouring cells."""
+
+    def __init__(self, coords, eps):
+        lat, lon = coords[:, 0], coords[:, 1]
+        # Two points within eps differ by at most eps in latitude and by at
+        # most 2*asin(sin(eps/2) / cos(lat)) in longitude at the worst latitude
+        min_cos = np.cos(np.abs(lat)).min()
+        lon_width = 2 * np.arcsin(min(1.0, np.sin(eps / 2) / max(min_cos, 1e-12)))
+        self.height, self.width = eps * (1 + 1e-9), lon_width * (1 + 1e-9)
+
+        row = np.floor((lat - lat.min()) / self.height).astype(np.int64)
+        col = np.floor((lon - lon.min()) / self.width).astype(np.int64)
+        ncols = col.max() + 3
+        key = row * ncols + (col + 1)
+
+        self.order = np.argsort(key, kind="stable")
+        keys, starts, sizes = np.unique(key[self.order], return_index=True, return_counts=True)
+
+        # Every neighbouring (cell, cell) pair, cut into pieces of whole rows
+        # of the first cell so that no piece exceeds BLOCK_SIZE candidates
+        pieces = []
+        for drow, dcol in _FORWARD:
+            target = keys + drow * ncols + dcol
+            j = np.searchsorted(keys, target)
+            found = j < len(keys)
+            found[found] = keys[j[found]] == target[found]
+            i, j = np.flatnonzero(found), j[found]
+            step = np.maximum(1, BLOCK_SIZE // sizes[j])
+            cuts = -(-sizes[i] // step)
+            piece = np.repeat(np.arange(len(i)), cuts)
+            first_row = (np.arange(len(piece)) - np.repeat(np.cumsum(cuts) - cuts, cuts)) * step[piece]
+            pieces.append(np.column_stack([
+                starts[i][piece] + first_row,                                     # first a
+                np.minimum(step[piece], sizes[i][piece] - first_row),             # rows of a
+                starts[j][piece],                                                 # first b
+                sizes[j][piece],                                                  # rows of b
+                np.where(drow == 0 and dcol == 0, first_row, -1),                 # same cell: a's offset
+            ]))
+        self.pieces = np.concatenate(pieces)
+
+    def wraps(self, coords):
+        """Whether neighbours could sit across the antimeridian."""
+        lon = coords[:, 1]
+        return lon.min() + 2 * np.pi - lon.max() <= self.width
+
+    def pairs(self):
+        """Yield ``(a, b)`` arrays of candidate point pairs, each unordered
+        pair of distinct points once, about ``BLOCK_SIZE`` at a time."""
+        a0, na, b0, nb, same = self.pieces.T
+        total = na * nb
+        bounds = np.searchsorted(np.cumsum(total), np.arange(BLOCK_SIZE, total.sum() + BLOCK_SIZE, BLOCK_SIZE))
+        lo = 0
+        for hi in np.unique(np.minimum(bounds + 1, len(total))):
+            sl = slice(lo, hi)
+            piece = np.repeat(np.arange(hi - lo), total[sl])
+            offset = np.arange(len(piece)) - np.repeat(np.cumsum(total[sl]) - total[sl], total[sl])
+            ia, ib = np.divmod(offset, nb[sl][piece])
+            # Within a cell keep each pair once and skip the point itself
+            keep = (same[sl][piece] < 0) | (same[sl][piece] + ia < ib)
+            yield (self.order[(a0[sl][piece] + ia)[keep]],
+                   self.order[(b0[sl][piece] + ib)[keep]])
+            lo = hi
+
+
+def radius_pairs(coords, queries, candidates, eps):
+    """All ``(q, c)`` with ``q`` in ``queries`` and ``c`` in ``candidates``
+    (index arrays into ``coords``) no more than ``eps`` apart.
+
+    Both sides are first cut down to the other's bounding box grown by eps,
+    so the ball tree only covers the neighbourhood of interest.
+    """
+    queries, candidates = np.asarray(queries, dtype=np.int64), np.asarray(candidates, dtype=np.int64)
+    empty = np.empty(0, dtype=np.int64)
+    for _ in range(2):
+        if len(queries) == 0 or len(candidates) == 0:
+            return empty, empty
+        lat, lon = coords[queries, 0], coords[queries, 1]
+        min_cos = np.cos(np.minimum(np.abs(lat).max() + eps, np.pi / 2))
+        lon_margin = 2 * np.arcsin(min(1.0, np.sin(eps / 2) / max(min_cos, 1e-12)))
+        inside = (
+            (coords[candidates, 0] >= lat.min() - eps) & (coords[candidates, 0] <= lat.max() + eps)
+            & (coords[candidates, 1] >= lon.min() - lon_margin) & (coords[candidates, 1] <= lon.max() + lon_margin)
+        )
+        if lon.min() - lon_margin > -np.pi and lon.max() + lon_margin < np.pi:
+            candidates = candidates[inside]
+        queries, candidates = candidates, queries
+    if len(queries) == 0 or len(candidates) == 0:
+        return empty, empty
+
+    tree = BallTree(coords[candidates], metric="haversine")
+    found = tree.query_radius(coords[queries], r=eps)
+    sizes = np.fromiter((len(f) for f in found), dtype=np.int64, count=len(found))
+    return np.repeat(queries, sizes), candidates[np.concatenate(found).astype(np.int64)]
+
+
+def grid_dbscan(coords, eps, min_samples, return_counts=False):
+    """Haversine DBSCAN labels for ``coords`` (radians), matching sklearn.
+
+    With ``return_counts`` the neighbourhood size of every point (itself
+    included) is returned as well.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    n = len(coords)
+    if n == 0:
+        empty = np.empty(0, dtype=np.int64)
+        return (empty, empty) if return_counts else empty
+    grid = _Grid(coords, eps)
+    if grid.wraps(coords):
+        labels = sklearn_dbscan(coords, eps, min_samples)
+        if not return_counts:
+            return labels
+        counts = BallTree(coords, metric="haversine").query_radius(coords, r=eps, count_only=True)
+        return labels, counts.astype(np.int64)
+
+    def near_pairs():
+        for a, b, _ in neighbor_pairs(coords, eps, grid):
+            yield a, b
+
+    labels, counts = dbscan_from_pairs(n, near_pairs, min_samples)
+    return (labels, counts) if return_counts else labels
+
+
+def neighbor_pairs(coords, eps, grid=None):
+    """Yield ``(a, b, rdist)`` blocks listing every unordered pair of distinct
+    points within ``eps`` once, with their reduced haversine distance.
+
+    The cut-off is the one :func:`grid_dbscan` applies, so the pairs are
+    exactly the ones it clusters on.
+    """
+    lat, lon = coords[:, 0], coords[:, 1]
+    cos = np.cos(lat)
+    limit = np.sin(0.5 * eps) ** 2
+    grid = _Grid(coords, eps) if grid is None else grid
+    if grid.wraps(coords):
+        found = BallTree(coords, metric="haversine").query_radius(coords, r=eps)
+        sizes = np.fromiter((len(f) for f in found), dtype=np.int64, count=len(found))
+        a, b = np.repeat(np.arange(len(coords)), sizes), np.concatenate(found).astype(np.int64)
+        candidates = [(a[a < b], b[a < b])]
+    else:
+        candidates = grid.pairs()
+    for a, b in candidates:
+        rdist = _rdist(lat[a], lon[a], cos[a], lat[b], lon[b], cos[b])
+        near = rdist <= limit
+        yield a[near], b[near], rdist[near]
+
+
+def dbscan_from_pairs(n, near_pairs, min_samples):
+    """DBSCAN ``(labels, counts)`` for ``n`` points given their neighbours.
+
+    ``near_pairs`` is a callable returning an iterable of ``(a, b)`` index
+    arrays that together list every unordered pair of distinct points within
+    eps exactly once; it is called up to three times.  Labels follow
+    sklearn's numbering and border-point rules.
+    """
+    # Pass 1: neighbourhood sizes (each point counts itself, as in sklearn)
+    counts = np.ones(n, dtype=np.int64)
+    cached, stored = [], 0
+    index = np.int32 if n < np.iinfo(np.int32).max else np.int64
+    for a, b in near_pairs():
+        counts += np.bincount(a, minlength=n) + np.bincount(b, minlength=n)
+        stored += len(a)
+        if cached is not None and stored <= MAX_CACHED_PAIRS:
+            cached.append((a.astype(index), b.astype(index)))
+        else:
+            cached = None
+    core = counts >= min_samples
+    if cached is not None:
+        near_pairs = cached.__iter__
+
+    # Pass 2: connect core points.  Pairs that are held in memory anyway are
+    # linked directly; otherwise each chunk is reduced to a spanning star per
+    # local component so the global edge list stays O(n).
+    heads, tails = [np.flatnonzero(core)], [np.flatnonzero(core)]
+    for a, b in near_pairs():
+        both = core[a] & core[b]
+        if not both.any():
+            continue
+        if cached is not None:
+            heads.append(a[both])
+            tails.append(b[both])
+            continue
+        nodes, local = np.unique(np.concatenate([a[both], b[both]]), return_inverse=True)
+        half = both.sum()
+        graph = coo_matrix((np.ones(half, dtype=bool), (local[:half], local[half:])), shape=(len(nodes),) * 2)
+        _, component = connected_components(graph, directed=False)
+        _, first = np.unique(component, return_index=True)
+        heads.append(nodes)
+        tails.append(nodes[first[component]])
+    heads, tails = np.concatenate(heads), np.concatenate(tails)
+    graph = coo_matrix((np.ones(len(heads), dtype=bool), (heads, tails)), shape=(n, n))
+    _, component = connected_components(graph, directed=False)
+
+    # Clusters are numbered in order of their lowest-index core point
+    labels = np.full(n, -1, dtype=np.int64)
+    core_idx = np.flatnonzero(core)
+    if len(core_idx):
+        seen, first_core = np.unique(component[core_idx], return_index=True)
+        rank = np.empty(component.max() + 1, dtype=np.int64)
+        rank[seen[np.argsort(first_core)]] = np.arange(len(seen))
+        labels[core_idx] = rank[component[core_idx]]
+
+    # Pass 3: border points join the lowest-numbered adjacent cluster
+    if not core.all():
+        unset = np.iinfo(np.int64).max
+        border = np.full(n, unset)
+        for a, b in near_pairs():
+            for x, y in ((a, b), (b, a)):
+                mixed = ~core[x] & core[y]
+                np.minimum.at(border, x[mixed], labels[y[mixed]])
+        reached = ~core & (border != unset)
+        labels[reached] = border[reached]
+    return labels, counts
+
+
+class NeighborGraph:
+    """Every pair of points within ``max_eps``, sorted by distance.
+
+    Built with one neighbour search; :meth:`labels` then gives the
+    :func:`grid_dbscan` labels for any ``eps <= max_eps`` and any
+    ``min_samples`` without searching again, and :meth:`matrix` the sparse
+    distance graph for ``DBSCAN(metric="precomputed")``.
+    """
+
+    def __init__(self, coords, max_eps):
+        coords = np.asarray(coords, dtype=np.float64)
+        self.n = len(coords)
+        self.max_eps = max_eps
+        blocks = list(neighbor_pairs(coords, max_eps)) if self.n else []
+        a, b, rdist = (np.concatenate(parts) for parts in zip(*blocks)) if blocks else (np.empty(0),) * 3
+        order = np.argsort(rdist, kind="stable")
+        index = np.int32 if self.n < np.iinfo(np.int32).max else np.int64
+        self.a, self.b, self.rdist = a[order].astype(index), b[order].astype(index), rdist[order]
+
+    def pairs(self, eps):
+        """``(a, b)`` arrays of the pairs within ``eps``."""
+        if eps > self.max_eps:
+            raise ValueError(f"eps {eps} is beyond the graph's {self.max_eps}")
+        k = np.searchsorted(self.rdist, np.sin(0.5 * eps) ** 2, side="right")
+        return self.a[:k], self.b[:k]
+
+    def labels(self, eps, min_samples):
+        """DBSCAN labels at ``eps``, identical to :func:`grid_dbscan`'s."""
+        if self.n == 0:
+            return np.empty(0, dtype=np.int64)
+        pairs = [self.pairs(eps)]
+        labels, _ = dbscan_from_pairs(self.n, pairs.__iter__, min_samples)
+        return labels
+
+    def matrix(self, eps):
+        """Symmetric sparse haversine distances (radians) of the pairs within ``eps``."""
+        a, b = self.pairs(eps)
+        distance = 2 * np.arcsin(np.sqrt(self.rdist[:len(a)]))
+        return csr_matrix((np.concatenate([distance, distance]), (np.concatenate([a, b]), np.concatenate([b, a]))),
+                          shape=(self.n, self.n))
+
+
+def project(coords, crs=None):
+    """Planar ``(x, y)`` metres for ``(lat, lon)`` radians.
+
+    ``crs`` defaults to the UTM zone of the points' mean longitude (UTM 13N,
+    EPSG:32613, for Colorado).
+    """
+    lat, lon = np.degrees(coords[:, 0]), np.degrees(coords[:, 1])
+    if crs is None:
+        zone = int(np.floor((lon.mean() + 180) / 6)) % 60 + 1
+        crs = f"EPSG:{32600 + zone if lat.mean() >= 0 else 32700 + zone}"
+    x, y = _transformer(crs).transform(lon, lat)
+    return np.column_stack([x, y])
+
+
+@lru_cache(maxsize=8)
+def _transformer(crs):
+    return Transformer.from_crs("EPSG:4326", crs, always_xy=True)
+
+
+def projected_dbscan(coords, eps, min_samples, xy=None):
+    """DBSCAN in a local metric projection with KD-tree neighbours.
+
+    ``eps`` stays in radians (arc length on the sphere) and is converted to
+    metres; pass already ``project``-ed points as ``xy`` to skip projecting.
+    Projection distortion makes labels differ slightly from the haversine
+    engines; ``bench projection`` reports by how much.
+    """
+    coords = np.asarray(coords, dtype=np.float64)
+    if len(coords) == 0:
+        return np.empty(0, dtype=np.int64)
+    xy = project(coords) if xy is None else xy
+    pairs = cKDTree(xy).query_pairs(eps * EARTH_RADIUS_M, output_type="ndarray")
+    labels, _ = dbscan_from_pairs(len(xy), lambda: [(pairs[:, 0], pairs[:, 1])], min_samples)
+    return labels
+
+
+ENGINES = {
+    "grid": grid_dbscan,
+    "projected": projected_dbscan,
+    "sklearn": sklearn_dbscan,
+}
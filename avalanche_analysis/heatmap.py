@@ -0,0 +1,82 @@
+"""Incident density rendered server-side as a single image overlay.
+
+Leaflet.heat needs every ``[lat, lon, count]`` triple in the browser and
+recomputes the kernel density on each pan and zoom.  Here the density is a
+Gaussian KDE evaluated once per filter set on a regular lat/lon grid (a binned
+histogram smoothed with ``scipy.ndimage.gaussian_filter``, so the cost grows
+with the grid rather than with incidents x pixels), colored with the
+Leaflet.heat gradient and shipped as one PNG ``ImageOverlay``.
+"""
+import numpy as np
+from folium.raster_layers import ImageOverlay
+from scipy.ndimage import gaussian_filter
+
+# Kernel standard deviation, in miles
+BANDWIDTH_MILES = 4.0
+
+# Grid resolution, in degrees of latitude per pixel
+CELL_DEGREES = 0.02
+MAX_PIXELS = 1024
+
+# Leaflet.heat's default gradient
+GRADIENT = {0.4: (0, 0, 255), 0.6: (0, 255, 255), 0.7: (0, 255, 0), 0.8: (255, 255, 0), 1.0: (255, 0, 0)}
+
+_MILES_PER_DEGREE = 69.0
+
+
+def density_grid(lat, lon, bounds, shape, bandwidth=BANDWIDTH_MILES):
+    """Gaussian KDE of the points on a ``shape`` grid over ``bounds``.
+
+    ``bounds`` is ``[[south, west], [north, east]]``; row 0 of the result is
+    the northern edge.  Values are relative densities (peak 1).
+    """
+    (south, west), (north, east) = bounds
+    rows, cols = shape
+    counts, _, _ = np.histogram2d(lat, lon, bins=shape, range=[[south, north], [west, east]])
+    counts = counts[::-1]
+
+    mid_lat = np.radians((south + north) / 2)
+    sigma_rows = bandwidth / _MILES_PER_DEGREE / ((north - south) / rows)
+    sigma_cols = bandwidth / (_MILES_PER_DEGREE * np.cos(mid_lat)) / ((east - west) / cols)
+    density = gaussian_filter(counts, sigma=(sigma_rows, sigma_cols), mode="constant")
+    peak = density.max()
+    return density / peak if peak > 0 else density
+
+
+def colorize(density):
+    """RGBA floats for a relative density grid, transparent where empty."""
+    stops = sorted(GRADIENT)
+    rgba = np.zeros(density.shape + (4,))
+    for channel in range(3):
+        rgba[..., channel] = np.interp(density, stops, [GRADIENT[s][channel] / 255 for s in stops])
+    # Like Leaflet.heat, opacity follows the density
+    rgba[..., 3] = np.clip(density / stops[0], 0, 1) * 0.8
+    return rgba
+
+
+def grid_bounds(lat, lon, bandwidth=BANDWIDTH_MILES):
+    """Data extent padded by three kernel widths."""
+    pad_lat = 3 * bandwidth / _MILES_PER_DEGREE
+    pad_lon = pad_lat / max(np.cos(np.radians(np.abs(lat).max())), 0.1)
+    return [[float(lat.min() - pad_lat), float(lon.min() - pad_lon)],
+            [float(lat.max() + pad_lat), float(lon.max() + pad_lon)]]
+
+
+def density_image(clustered, bandwidth=BANDWIDTH_MILES):
+    """``(rgba, bounds)`` for the incidents in ``clustered``, or None if empty."""
+    points = clustered[["lat", "lon"]].dropna()
+    if points.empty:
+        return None
+    lat, lon = points["lat"].to_numpy(dtype=float), points["lon"].to_numpy(dtype=float)
+    bounds = grid_bounds(lat, lon, bandwidth)
+    (south, west), (north, east) = bounds
+    scale = max((north - south) / CELL_DEGREES, (east - west) / CELL_DEGREES) / MAX_PIXELS
+    cell = CELL_DEGREES * max(1.0, scale)
+    shape = (max(1, int(np.ceil((north - south) / cell))), max(1, int(np.ceil((east - west) / cell))))
+    return colorize(density_grid(lat, lon, bounds, shape, bandwidth)), bounds
+
+
+def heat_layer(image):
+    """Folium overlay for a ``density_image`` result."""
+    rgba, bounds = image
+    return ImageOverlay(rgba, bounds=bounds, mercator_project=True, pixelated=False, name="Incident density")
@@ -0,0 +1,157 @@
+"""Incremental DBSCAN for appended accident records.
+
+A new CAIC export only appends a handful of incidents to a history going back
+to 1953, so instead of reclustering everything :class:`IncrementalClustering`
+keeps each point's neighbourhood size next to its label and, on ``append``,
+only queries the neighbourhoods of the new points and of the points they
+promote to core.  Clusters that merge or grow are renumbered the way sklearn
+numbers them (by their lowest core point), border points next to a changed
+cluster are re-assigned, and only clusters whose membership changed are
+re-hulled.
+
+The result is identical to a full recompute, which stays available through
+:meth:`IncrementalClustering.full_recompute` and :meth:`verify`.
+"""
+import numpy as np
+import pandas as pd
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+
+from avalanche_analysis import pipeline
+from avalanche_analysis.clustering import grid_dbscan, radius_pairs
+
+_UNSET = np.iinfo(np.int64).max
+
+
+class IncrementalClustering:
+    """Cluster labels, neighbourhood sizes and hulls of a normalized frame.
+
+    ``labels`` follows the positional order of ``df`` and keeps noise as -1;
+    ``hulls`` is the :func:`pipeline.build_hulls` frame of the clustered rows.
+    """
+
+    def __init__(self, df, eps=pipeline.EPS_DISTANCE, min_samples=pipeline.MIN_SAMPLES):
+        self.eps = eps
+        self.min_samples = min_samples
+        self.df = df
+        self.labels, self.counts, self.hulls = self.full_recompute()
+
+    def _coords(self, df=None):
+        df = self.df if df is None else df
+        return np.radians(df[["lat", "lon"]].to_numpy(dtype=np.float64))
+
+    def _clustered(self, df, labels, keep=None):
+        keep = labels >= 0 if keep is None else keep
+        return df[keep].assign(cluster=labels[keep])
+
+    def full_recompute(self, df=None):
+        """``(labels, counts, hulls)`` for ``df`` computed from scratch."""
+        df = self.df if df is None else df
+        if len(df) > 1:
+            labels, counts = grid_dbscan(self._coords(df), self.eps, self.min_samples, return_counts=True)
+        else:
+            # Same single-incident rule as pipeline.cluster_incidents
+            labels, counts = np.zeros(len(df), dtype=np.int64), np.ones(len(df), dtype=np.int64)
+        return labels, counts, pipeline.build_hulls(self._clustered(df, labels))
+
+    def append(self, new_rows):
+        """Absorb ``new_rows`` and return the (new) ids of re-hulled clusters."""
+        n0 = len(self.df)
+        df = pd.concat([self.df, new_rows])
+        if n0 < 2:
+            self.df = df
+            self.labels, self.counts, self.hulls = self.full_recompute()
+            return set(self.labels[self.labels >= 0].tolist())
+
+        coords = self._coords(df)
+        n = len(df)
+        new = np.arange(n0, n)
+        was_core = np.append(self.counts >= self.min_samples, np.zeros(len(new), dtype=bool))
+
+        # Neighbourhood sizes: new points count everything around them (self
+        # included); old points gain one per new neighbour.
+        q, c = radius_pairs(coords, new, np.arange(n), self.eps)
+        counts = np.append(self.counts, np.zeros(len(new), dtype=np.int64))
+        counts += np.bincount(q, minlength=n)
+        counts += np.bincount(c[c < n0], minlength=n)
+        core = counts >= self.min_samples
+
+        # Points that became core need their full neighbourhood for linking
+        promoted = np.flatnonzero(core[:n0] & ~was_core[:n0])
+        q2, c2 = radius_pairs(coords, promoted, np.arange(n0), self.eps)
+        heads, tails = np.concatenate([q, q2]), np.concatenate([c, c2])
+        linked = core[heads] & core[tails]
+        heads, tails = heads[linked], tails[linked]
+
+        # Graph nodes: one per previous cluster, one per new or promoted core
+        old_labels = self.labels
+        n_old = int(old_labels.max()) + 1 if len(old_labels) else 0
+        fresh = np.concatenate([new[core[new]], promoted])
+        node = np.full(n, -1, dtype=np.int64)
+        node[:n0][was_core[:n0]] = old_labels[was_core[:n0]]
+        node[fresh] = n_old + np.arange(len(fresh))
+        n_nodes = n_old + len(fresh)
+        if n_nodes == 0:
+            # No cluster before and no core point now: everything stays noise
+            self.df, self.labels, self.counts = df, np.full(n, -1, dtype=np.int64), counts
+            return set()
+
+        graph = coo_matrix((np.ones(len(heads), dtype=bool), (node[heads], node[tails])), shape=(n_nodes, n_nodes))
+        _, component = connected_components(graph, directed=False)
+
+        # Renumber components by their lowest core point, as sklearn does
+        lowest = np.full(n_nodes, _UNSET)
+        old_core = np.flatnonzero(was_core[:n0])
+        np.minimum.at(lowest, old_labels[old_core], old_core)
+        lowest[n_old:] = fresh
+        component_lowest = np.full(component.max() + 1, _UNSET)
+        np.minimum.at(component_lowest, component, lowest)
+        number = np.empty_like(component_lowest)
+        number[np.argsort(component_lowest)] = np.arange(len(component_lowest))
+        relabel = number[component[:n_old]]
+
+        labels = np.full(n, -1, dtype=np.int64)
+        labels[:n0][old_labels >= 0] = relabel[old_labels[old_labels >= 0]]
+        labels[fresh] = number[component[n_old:]]
+
+        # Border points beside a grown, merged or new cluster may now prefer
+        # another cluster, and new non-core points have no label yet.
+        touched = np.zeros(len(component_lowest), dtype=bool)
+        touched[component[n_old:]] = True
+        touched_core = np.flatnonzero(core & (node >= 0))
+        touched_core = touched_core[touched[component[node[touched_core]]]]
+        non_core = np.flatnonzero(~core)
+        q3, _ = radius_pairs(coords, non_core, touched_core, self.eps)
+        recheck = np.union1d(q3, new[~core[new]])
+        q4, c4 = radius_pairs(coords, recheck, np.flatnonzero(core), self.eps)
+        border = np.full(n, _UNSET)
+        np.minimum.at(border, q4, labels[c4])
+        labels[recheck] = np.where(border[recheck] == _UNSET, -1, border[recheck])
+
+        # Re-hull clusters that grew, merged or appeared, and those that lost
+        # or gained a border point
+        previous = np.full(n, -1, dtype=np.int64)
+        previous[:n0][old_labels >= 0] = relabel[old_labels[old_labels >= 0]]
+        moved = labels != previous
+        dirty = set(number[touched].tolist())
+        dirty |= set(labels[moved].tolist()) | set(previous[moved].tolist())
+        dirty.discard(-1)
+
+        kept = self.hulls.assign(cluster=relabel[self.hulls["cluster"].to_numpy()])
+        kept = kept[~kept["cluster"].isin(dirty)]
+        in_dirty = np.isin(labels, list(dirty))
+        rebuilt = pipeline.build_hulls(self._clustered(df, labels, keep=in_dirty))
+        hulls = pd.concat([kept, rebuilt]).sort_values("cluster", kind="stable").reset_index(drop=True)
+
+        self.df, self.labels, self.counts, self.hulls = df, labels, counts, hulls
+        return dirty
+
+    def verify(self):
+        """Whether the incremental state equals a full recompute."""
+        labels, counts, hulls = self.full_recompute()
+        return (
+            np.array_equal(labels, self.labels)
+            and np.array_equal(counts, self.counts)
+            and hulls.drop(columns="geometry").equals(self.hulls.drop(columns="geometry"))
+            and bool(hulls.geometry.geom_equals_exact(self.hulls.geometry, 0).all())
+        )
@@ -0,0 +1,102 @@
+"""Workbook ingestion with an Arrow snapshot cache.
+
+Parsing the CAIC workbook through openpyxl takes seconds, so the first load
+converts it into an Arrow IPC snapshot named after the workbook's content
+hash.  Later loads memory-map that snapshot instead of touching the workbook,
+and an edited spreadsheet hashes differently, which triggers a rebuild.
+"""
+import glob
+import hashlib
+import os
+import threading
+
+import pandas as pd
+import pyarrow as pa
+
+# Snapshots live next to the workbook unless AVALANCHE_CACHE_DIR says otherwise
+CACHE_DIR = os.environ.get("AVALANCHE_CACHE_DIR", ".cache")
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """Return the sha256 hex digest of the file at ``path``."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def snapshot_path(path, digest, cache_dir=None):
+    """Where the snapshot of ``path`` with content hash ``digest`` is stored."""
+    cache_dir = cache_dir or os.path.join(os.path.dirname(os.path.abspath(path)), CACHE_DIR)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(cache_dir, f"{stem}.{digest[:16]}.arrow")
+
+
+def read_workbook(path):
+    """Parse the workbook directly (the slow path)."""
+    return pd.read_excel(path)
+
+
+def _arrow_safe(df):
+    # Spreadsheet columns often mix numbers and text; Arrow needs one type
+    # per column, so mixed object columns are stored as strings.
+    df = df.copy()
+    for col in df.columns[df.dtypes == object]:
+        values = df[col].dropna()
+        if not values.map(type).eq(str).all():
+            df[col] = df[col].where(df[col].isna(), df[col].astype(str))
+    df.columns = [str(c) for c in df.columns]
+    return df
+
+
+def temp_path(target):
+    """Scratch name next to ``target`` for an atomic write.
+
+    Unique per thread as well as per process: Streamlit sessions share one
+    process, and two of them can build the same file on a cold cache.
+    """
+    return f"{target}.tmp{os.getpid()}.{threading.get_ident()}"
+
+
+def write_snapshot(df, target):
+    """Write ``df`` to ``target`` as an uncompressed Arrow IPC file."""
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    table = pa.Table.from_pandas(_arrow_safe(df), preserve_index=False)
+    tmp = temp_path(target)
+    with pa.OSFile(tmp, "wb") as sink, pa.ipc.new_file(sink, table.schema) as writer:
+        writer.write_table(table)
+    os.replace(tmp, target)
+
+
+def read_snapshot(target, columns=None):
+    """Memory-map the Arrow snapshot at ``target`` into a DataFrame.
+
+    Only ``columns`` (all by default) are converted, and text columns come
+    back as categoricals.
+    """
+    with pa.memory_map(target, "r") as source:
+        table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+        return table.to_pandas(strings_to_categorical=True)
+
+
+def load_incidents(path, cache_dir=None, refresh=False, columns=None):
+    """Load the CAIC workbook, going through the snapshot cache.
+
+    The workbook is only parsed when no snapshot matches its current content
+    hash (or ``refresh`` is set); stale snapshots of the same workbook are
+    removed when a new one is written.  ``columns`` projects the snapshot.
+    """
+    target = snapshot_path(path, file_digest(path), cache_dir)
+    if not refresh and os.path.exists(target):
+        return read_snapshot(target, columns)
+
+    df = read_workbook(path)
+    stale = glob.glob(snapshot_path(path, "*", cache_dir))
+    write_snapshot(df, target)
+    for old in stale:
+        if old != target:
+            os.remove(old)
+    return read_snapshot(target, columns)
@@ -0,0 +1,157 @@
+"""Incidents and cluster zones near a point.
+
+Incident points live in an R-tree (``rtree``) that is bulk-loaded once per
+workbook version and kept on disk next to the workbook snapshot, so a new
+process opens it instead of rebuilding it.  Its ids are row positions in the
+normalized frame.  A lookup takes the tree's candidates in the bounding box
+of the search circle and keeps those within the haversine radius.
+
+Cluster zones depend on the sidebar selection and number in the hundreds, so
+they go into an in-memory shapely ``STRtree`` built alongside each hull set.
+"""
+import glob
+import os
+import threading
+
+import numpy as np
+import shapely
+from rtree import index
+
+from avalanche_analysis import ingest, pipeline
+
+# Points per R-tree node; larger leaves mean a shallower tree on disk
+LEAF_CAPACITY = 64
+
+
+def index_base(path, digest, cache_dir=None):
+    """Base name of the index files (``rtree`` adds ``.idx`` and ``.dat``)."""
+    return ingest.snapshot_path(path, digest, cache_dir)[:-len(".arrow")] + ".incidents"
+
+
+def _properties():
+    properties = index.Property()
+    properties.leaf_capacity = LEAF_CAPACITY
+    properties.fill_factor = 0.9
+    return properties
+
+
+def build_index(base, df):
+    """Bulk-load an R-tree of the incident points of ``df`` into ``base``."""
+    os.makedirs(os.path.dirname(base), exist_ok=True)
+    points = df[["lon", "lat"]].to_numpy(dtype=np.float64)
+    tmp = ingest.temp_path(base)
+    tree = index.Index(tmp, (np.arange(len(df), dtype=np.int64), points, points), properties=_properties())
+    tree.close()
+    # Data before the header, so a reader never finds a header without data
+    os.replace(f"{tmp}.dat", f"{base}.dat")
+    os.replace(f"{tmp}.idx", f"{base}.idx")
+
+
+def search_boxes(lats, lons, radius_miles):
+    """``[[min_lon, min_lat, max_lon, max_lat], ...]`` degrees around each search circle."""
+    lats, lons = np.atleast_1d(np.asarray(lats, dtype=np.float64)), np.atleast_1d(np.asarray(lons, dtype=np.float64))
+    arc = radius_miles / pipeline.EARTH_RADIUS_MILES
+    dlat = np.degrees(arc)
+    top = np.minimum(np.abs(lats) + dlat, 90.0)
+    dlon = np.where(top < 90.0, np.degrees(arc / np.cos(np.radians(top))), 180.0)
+    # Around a pole or across the antimeridian: every longitude
+    wide = (dlon >= 180.0) | (np.abs(lons) + dlon > 180.0)
+    return np.column_stack([
+        np.where(wide, -180.0, lons - dlon), np.maximum(lats - dlat, -90.0),
+        np.where(wide, 180.0, lons + dlon), np.minimum(lats + dlat, 90.0),
+    ])
+
+
+def haversine_miles(lat, lon, lats, lons):
+    """Great-circle miles between points (degrees, broadcast like numpy)."""
+    lat, lon, lats, lons = (np.radians(np.asarray(v, dtype=np.float64)) for v in (lat, lon, lats, lons))
+    h = np.sin(0.5 * (lats - lat)) ** 2 + np.cos(lat) * np.cos(lats) * np.sin(0.5 * (lons - lon)) ** 2
+    return 2 * pipeline.EARTH_RADIUS_MILES * np.arcsin(np.sqrt(np.minimum(h, 1.0)))
+
+
+class IncidentIndex:
+    """Radius lookups over the persisted R-tree of one normalized frame."""
+
+    def __init__(self, base, df):
+        self._tree = index.Index(base)
+        self._lat = df["lat"].to_numpy(dtype=np.float64)
+        self._lon = df["lon"].to_numpy(dtype=np.float64)
+        # libspatialindex handles are not safe to query from several threads
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._lat)
+
+    def within(self, lat, lon, radius_miles):
+        """``(rows, miles)``: positions of the incidents within ``radius_miles``
+        of ``(lat, lon)`` and their distances, nearest first."""
+        box = search_boxes(lat, lon, radius_miles)
+        with self._lock:
+            rows, _ = self._tree.intersection_v(box[:, :2], box[:, 2:])
+        miles = haversine_miles(lat, lon, self._lat[rows], self._lon[rows])
+        near = miles <= radius_miles
+        order = np.argsort(miles[near], kind="stable")
+        return rows[near][order], miles[near][order]
+
+    def count_within(self, lats, lons, radius_miles, selected=None):
+        """Number of incidents within ``radius_miles`` of each point, counting
+        only rows where the boolean mask ``selected`` is set when given."""
+        lats, lons = np.asarray(lats, dtype=np.float64), np.asarray(lons, dtype=np.float64)
+        boxes = search_boxes(lats, lons, radius_miles)
+        with self._lock:
+            rows, counts = self._tree.intersection_v(boxes[:, :2], boxes[:, 2:])
+        query = np.repeat(np.arange(len(boxes)), counts.astype(np.int64))
+        if selected is not None:
+            keep = selected[rows]
+            rows, query = rows[keep], query[keep]
+        miles = haversine_miles(lats[query], lons[query], self._lat[rows], self._lon[rows])
+        return np.bincount(query[miles <= radius_miles], minlength=len(boxes))
+
+    def in_boxes(self, boxes):
+        """Sorted positions of the incidents inside any of ``boxes``
+        (``[[min_lon, min_lat, max_lon, max_lat], ...]``)."""
+        if len(boxes) == 0:
+            return np.empty(0, dtype=np.int64)
+        with self._lock:
+            rows, _ = self._tree.intersection_v(boxes[:, :2], boxes[:, 2:])
+        return np.unique(rows)
+
+    def close(self):
+        self._tree.close()
+
+
+def load_index(path, df, cache_dir=None):
+    """The :class:`IncidentIndex` of the workbook at ``path``, whose
+    normalized frame is ``df``, building the files when they are missing."""
+    digest = ingest.file_digest(path)
+    base = index_base(path, digest, cache_dir)
+    if not os.path.exists(f"{base}.idx"):
+        build_index(base, df)
+        for old in glob.glob(index_base(path, "*", cache_dir) + ".*"):
+            if not old.startswith(f"{base}."):
+                os.remove(old)
+    return IncidentIndex(base, df)
+
+
+class ZoneIndex:
+    """Point-in-zone lookups over one hull frame."""
+
+    def __init__(self, hulls):
+        self.hulls = hulls
+        self._tree = shapely.STRtree(hulls.geometry.values)
+
+    def containing(self, lat, lon):
+        """The rows of the hull frame whose polygon contains ``(lat, lon)``."""
+        hits = self._tree.query(shapely.points(lon, lat), predicate="intersects")
+        return self.hulls.iloc[np.sort(hits)]
+
+    def crossing(self, geometry):
+        """Sorted positions of the hull rows whose polygon ``geometry`` touches."""
+        return np.sort(self._tree.query(geometry, predicate="intersects"))
+
+    def containing_many(self, lats, lons):
+        """``(points, zones)``: aligned positions of the points and of the hull
+        rows containing them, ordered by point then zone."""
+        points, zones = self._tree.query(shapely.points(lons, lats), predicate="intersects")
+        order = np.lexsort((zones, points))
+        return points[order], zones[order]
@@ -0,0 +1,464 @@
+"""The load -> normalize -> cluster -> hull stages behind the map.
+
+Each stage exists twice: as a plain function over DataFrames, used by scripts
+and batch jobs, and as a memoized stage keyed on hashable inputs (workbook
+path and version, sorted traveler-type tuple).  The memo tables live at module
+level, so they are shared by every Streamlit session in the process and a
+filter combination that has been seen before skips straight to rendering.
+Cluster and hull lookups are answered from the precomputed subset artifact
+(see :mod:`avalanche_analysis.precompute`), which is built on first use when
+the deploy-time warm-up has not already produced it.  Lookups scoped to a
+:class:`seasons.TimeWindow` slice the frame through the season index and are
+memoized per window.  Clustering at other than the default radius and
+minimum size relabels a neighbour graph built once per selection at the
+largest sweep radius (see :class:`clustering.NeighborGraph`).
+
+Values handed out by the memoized stages are shared; callers must not mutate
+them.
+"""
+import inspect
+import os
+import threading
+from collections import OrderedDict
+from functools import wraps
+
+import geopandas as gpd
+import numpy as np
+import pandas as pd
+import shapely
+
+from avalanche_analysis import heatmap, nearby, playback, precompute, profiling, render, seasons, tracks
+from avalanche_analysis.clustering import ENGINES, NeighborGraph, project
+from avalanche_analysis.ingest import load_incidents
+
+# Map the CAIC activity labels onto the five traveler types shown on the map
+TRAVELER_MAPPING = {
+    "backcountry_tourer": "skier",
+    "ski_patroller": "skier",
+    "sidecountry_rider": "skier",
+    "inbounds_rider": "skier",
+    "hybrid_tourer": "skier",
+    "human-powered_guide_client": "skier",
+
+    "snowmobiler": "mechanized",
+    "mechanised_guide": "mechanized",
+    "mechanized_guided_client": "mechanized",
+    "mechanized_guide": "mechanized",
+    "mechanized_guiding_client": "mechanized",
+    "snowbiker": "mechanized",
+    "motorist": "mechanized",
+
+    "hiker": "hiker",
+    "climber": "hiker",
+    "snowplayer": "hiker",
+    "hunter": "hiker",
+    "hybrid_rider": "hiker",
+    "misc_recreation": "hiker",
+
+    "miner": "occupational_hazard",
+    "rescuer": "occupational_hazard",
+    "ranger": "occupational_hazard",
+    "highway_personnel": "occupational_hazard",
+    "others_at_work": "occupational_hazard",
+
+    "resident": "miscellaneous",
+}
+
+# The only workbook columns the app uses
+INCIDENT_COLUMNS = ["YYYY", "MM", "DD", "Location", "PrimaryActivity", "lat", "lon"]
+
+TRAVELER_TYPES = ("skier", "mechanized", "hiker", "occupational_hazard", "miscellaneous")
+
+EARTH_RADIUS_MILES = 3958.8
+
+# 7 miles in radians of the earth's radius
+EPS_DISTANCE = 7 / EARTH_RADIUS_MILES
+MIN_SAMPLES = 2
+
+# Parameters offered by the sweep; the neighbour graph is built at the
+# largest radius
+SWEEP_RADII_MILES = (3, 5, 7, 10, 15)
+SWEEP_MIN_SAMPLES = (2, 3, 4, 5)
+SWEEP_MAX_EPS = max(SWEEP_RADII_MILES) / EARTH_RADIUS_MILES
+
+# Hull padding, in degrees
+HULL_BUFFER = 0.05
+
+
+# Plain stages:
+
+def normalize_incidents(raw):
+    """Drop unplaced incidents and map activities onto traveler types.
+
+    Only :data:`INCIDENT_COLUMNS` are kept, in compact dtypes: float32
+    coordinates, small integer dates and categorical text.
+    """
+    lat = pd.to_numeric(raw["lat"], errors="coerce")
+    lon = pd.to_numeric(raw["lon"], errors="coerce")
+    placed = (lat != 0.0) & (lon != 0.0) & lat.notna() & lon.notna()
+    raw = raw[placed]
+
+    # Normalize and map the (few) activity labels rather than every row
+    activity = raw["PrimaryActivity"].astype("category").cat
+    mapped = activity.categories.str.lower().str.replace(" ", "_").map(TRAVELER_MAPPING)
+    lookup = np.append(pd.Categorical(mapped, categories=TRAVELER_TYPES).codes, -1)
+
+    return pd.DataFrame({
+        "YYYY": _compact_int(raw["YYYY"], np.int16),
+        "MM": _compact_int(raw["MM"], np.int8),
+        "DD": _compact_int(raw["DD"], np.int8),
+        "Location": raw["Location"].astype("category"),
+        "PrimaryActivity": pd.Categorical.from_codes(lookup[activity.codes], categories=TRAVELER_TYPES),
+        "lat": lat[placed].astype(np.float32),
+        "lon": lon[placed].astype(np.float32),
+    }, index=raw.index)
+
+
+def _compact_int(column, dtype):
+    column = pd.to_numeric(column, errors="coerce")
+    if column.isna().any():
+        return column.astype(pd.api.types.pandas_dtype(dtype).name.capitalize())
+    return column.astype(dtype)
+
+
+def frame_bytes(df):
+    """Memory held by ``df``, text and categories included."""
+    return int(df.memory_usage(deep=True).sum())
+
+
+def filter_types(df, types):
+    """Rows whose traveler type is in ``types`` (None selects unmapped rows)."""
+    return df[df["PrimaryActivity"].isin(list(types))]
+
+
+def cluster_incidents(df, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES, engine="grid", xy=None):
+    """Label incidents with haversine DBSCAN clusters and drop the noise.
+
+    ``engine`` names one of :data:`clustering.ENGINES`; "grid" and "sklearn"
+    produce identical labels, "projected" approximates them in a metric
+    projection and reuses ``xy`` (see :func:`project_incidents`) when given.
+    """
+    df = df.copy()
+    if len(df) > 1:  # Only run DBSCAN if we have enough points
+        coords = np.radians(df[["lat", "lon"]].to_numpy(dtype=np.float64))
+        extra = {"xy": xy.loc[df.index].to_numpy()} if engine == "projected" and xy is not None else {}
+        df["cluster"] = ENGINES[engine](coords, eps, min_samples, **extra)
+    else:
+        df["cluster"] = 0  # Assign every point to one cluster if too few data points exist
+    return df[df["cluster"] != -1]
+
+
+def incident_graph(df, max_eps=SWEEP_MAX_EPS):
+    """:class:`NeighborGraph` of the incidents of ``df`` out to ``max_eps``."""
+    return NeighborGraph(np.radians(df[["lat", "lon"]].to_numpy(dtype=np.float64)), max_eps)
+
+
+def relabel_incidents(df, graph, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES):
+    """:func:`cluster_incidents` of ``df`` from its :func:`incident_graph`."""
+    df = df.copy()
+    df["cluster"] = graph.labels(eps, min_samples) if len(df) > 1 else 0
+    return df[df["cluster"] != -1]
+
+
+def sweep_summary(graph, radii_miles=SWEEP_RADII_MILES, min_samples=SWEEP_MIN_SAMPLES):
+    """Clusters, clustered incidents and noise for every radius/minimum pair."""
+    rows = []
+    for miles in radii_miles:
+        for minimum in min_samples:
+            # As in cluster_incidents, a lone incident is its own cluster
+            labels = graph.labels(miles / EARTH_RADIUS_MILES, minimum) if graph.n > 1 else np.zeros(graph.n)
+            rows.append({"radius_miles": miles, "min_samples": minimum, "clusters": int(labels.max(initial=-1)) + 1,
+                         "clustered": int((labels >= 0).sum()), "noise": int((labels < 0).sum())})
+    return pd.DataFrame(rows)
+
+
+def project_incidents(df, crs=None):
+    """Planar ``x``/``y`` metres per incident, indexed like ``df``."""
+    coords = np.radians(df[["lat", "lon"]].to_numpy(dtype=np.float64))
+    xy = project(coords, crs) if len(df) else np.empty((0, 2))
+    return pd.DataFrame(xy, columns=["x", "y"], index=df.index)
+
+
+def hull_frame(clusters, counts, traveler_types, shares, polygons):
+    """GeoDataFrame of cluster polygons; ``shares`` has one column per type."""
+    frame = pd.DataFrame({
+        "cluster": np.asarray(clusters, dtype=np.int64),
+        "count": np.asarray(counts, dtype=np.int64),
+        "traveler_type": pd.Series(traveler_types, dtype=object),
+    })
+    for i, kind in enumerate(TRAVELER_TYPES):
+        frame[f"share_{kind}"] = np.asarray(shares, dtype=float).reshape(-1, len(TRAVELER_TYPES))[:, i]
+    return gpd.GeoDataFrame(frame, geometry=np.asarray(polygons, dtype=object), crs="EPSG:4326")
+
+
+def build_hulls(clustered, buffer=HULL_BUFFER, min_points=3):
+    """Buffered convex hull, dominant traveler type and type shares per cluster.
+
+    Incidents are sorted by label once and every hull is built by the shapely
+    array functions in a single pass; clusters with fewer than ``min_points``
+    incidents are skipped.  The dominant type is the most common one (ties go
+    to the alphabetically first, like ``Series.mode``), or None when no
+    incident in the cluster has a mapped type.
+    """
+    labels = clustered["cluster"].to_numpy()
+    order = np.argsort(labels, kind="stable")
+    clusters, counts = np.unique(labels[order], return_counts=True)
+    keep = counts >= min_points
+    members = np.repeat(keep, counts)
+
+    points = shapely.points(clustered["lon"].to_numpy()[order][members], clustered["lat"].to_numpy()[order][members])
+    groups = np.repeat(np.arange(keep.sum()), counts[keep])
+    hulls = shapely.convex_hull(shapely.multipoints(points, indices=groups))
+    polygons = shapely.buffer(hulls, buffer, quad_segs=16)
+
+    clusters, counts = clusters[keep], counts[keep]
+    # By position, so frames with repeated index labels tally too
+    tally = pd.crosstab(labels, clustered["PrimaryActivity"].to_numpy())
+    tally = tally.reindex(index=clusters, columns=sorted(TRAVELER_TYPES), fill_value=0)
+    dominant = tally.idxmax(axis=1).where(tally.sum(axis=1) > 0, None)
+    shares = tally[list(TRAVELER_TYPES)].to_numpy() / counts[:, None]
+    return hull_frame(clusters, counts, dominant.to_numpy(), shares, polygons)
+
+
+# Memoized stages:
+
+class StageCache:
+    """A small thread-safe LRU table with hit/miss counters."""
+
+    def __init__(self, name, maxsize=64):
+        self.name = name
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                self._entries.move_to_end(key)
+                return self._entries[key]
+            self.misses += 1
+        value = compute()
+        with self._lock:
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.hits = self.misses = 0
+
+
+STAGE_CACHES = OrderedDict()
+
+
+def stage(name, maxsize=64):
+    """Memoize a stage on its (hashable) positional arguments.
+
+    Omitted trailing arguments are keyed by their defaults, so ``cluster(p, v,
+    t)`` and ``cluster(p, v, t, None, EPS_DISTANCE, MIN_SAMPLES, "grid")``
+    share an entry.  Cache misses are recorded by
+    :mod:`avalanche_analysis.profiling` when it is enabled.
+    """
+    cache = STAGE_CACHES.setdefault(name, StageCache(name, maxsize))
+
+    def decorator(func):
+        defaults = tuple(p.default for p in inspect.signature(func).parameters.values())
+
+        @wraps(func)
+        def wrapper(*args):
+            key = args + defaults[len(args):]
+            return cache.get(key, lambda: profiling.run(name, func, *key))
+        wrapper.cache = cache
+        return wrapper
+    return decorator
+
+
+def stage_stats():
+    """Hit/miss counters per stage, for the debug sidebar."""
+    return pd.DataFrame(
+        [{"stage": c.name, "hits": c.hits, "misses": c.misses, "entries": len(c._entries)}
+         for c in STAGE_CACHES.values()]
+    ).set_index("stage")
+
+
+def clear_stages():
+    for cache in STAGE_CACHES.values():
+        cache.clear()
+
+
+def source_version(path):
+    """Cheap change marker for the workbook, used in every stage key."""
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def types_key(selection):
+    """Canonical, hashable form of a traveler-type selection."""
+    return tuple(sorted({None if pd.isna(t) else t for t in selection}, key=str))
+
+
+@stage("load", maxsize=4)
+def load(path, version):
+    return load_incidents(path, columns=INCIDENT_COLUMNS)
+
+
+@stage("normalize", maxsize=4)
+def normalize(path, version):
+    return normalize_incidents(load(path, version))
+
+
+@stage("projected", maxsize=4)
+def projected(path, version):
+    return project_incidents(normalize(path, version))
+
+
+@stage("subsets", maxsize=4)
+def subsets(path, version):
+    return precompute.load_artifact(path)
+
+
+@stage("season_index", maxsize=4)
+def season_index(path, version):
+    return seasons.SeasonIndex(normalize(path, version))
+
+
+def incidents(path, version, window=None):
+    """The normalized incidents, limited to ``window`` when one is given."""
+    df = normalize(path, version)
+    return df if window is None else season_index(path, version).slice(df, window)
+
+
+@stage("neighbors", maxsize=16)
+def neighbors(path, version, types, window=None):
+    return incident_graph(filter_types(incidents(path, version, window), types))
+
+
+@stage("sweep", maxsize=16)
+def sweep(path, version, types, window=None):
+    return sweep_summary(neighbors(path, version, types, window))
+
+
+@stage("cluster", maxsize=256)
+def cluster(path, version, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES, engine="grid"):
+    if engine == "projected":
+        # Approximate labels: the subset artifact and neighbour graph do not apply
+        df = filter_types(incidents(path, version, window), types)
+        return cluster_incidents(df, eps, min_samples, engine, projected(path, version))
+    default = eps == EPS_DISTANCE and min_samples == MIN_SAMPLES
+    if window is None and default:
+        artifact = subsets(path, version)
+        if types in artifact:
+            return artifact.clustered(normalize(path, version), types)
+    df = filter_types(incidents(path, version, window), types)
+    if not default and eps <= SWEEP_MAX_EPS:
+        return relabel_incidents(df, neighbors(path, version, types, window), eps, min_samples)
+    return cluster_incidents(df, eps, min_samples, engine)
+
+
+@stage("hull", maxsize=256)
+def hulls(path, version, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES, engine="grid"):
+    if engine != "projected" and window is None and eps == EPS_DISTANCE and min_samples == MIN_SAMPLES:
+        artifact = subsets(path, version)
+        if types in artifact:
+            return artifact.hulls(types)
+    return build_hulls(cluster(path, version, types, window, eps, min_samples, engine))
+
+
+@stage("incident_index", maxsize=2)
+def incident_index(path, version):
+    return nearby.load_index(path, normalize(path, version))
+
+
+@stage("zone_index", maxsize=16)
+def zone_index(path, version, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES):
+    return nearby.ZoneIndex(hulls(path, version, types, window, eps, min_samples))
+
+
+def near(path, version, lat, lon, radius_miles, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES):
+    """Incidents of the selection within ``radius_miles`` of ``(lat, lon)``
+    and the selection's cluster zones containing that point.
+
+    Returns ``(incidents, zones)``: the normalized rows, nearest first, with a
+    ``distance_miles`` column, and the matching rows of the hull frame.
+    """
+    rows, miles = incident_index(path, version).within(lat, lon, radius_miles)
+    found = normalize(path, version).iloc[rows].assign(distance_miles=miles)
+    found = filter_types(found, types)
+    if window is not None:
+        found = found[seasons.in_window(seasons.season_keys(found), window)]
+    return found, zone_index(path, version, types, window, eps, min_samples).containing(lat, lon)
+
+
+def near_many(path, version, lats, lons, radius_miles, types, window=None, eps=EPS_DISTANCE,
+              min_samples=MIN_SAMPLES):
+    """:func:`near` for many points at once, as counts.
+
+    Returns ``(counts, points, zones)``: the number of incidents of the
+    selection within ``radius_miles`` of each point, and aligned positions of
+    the points and of the hull rows containing them.
+    """
+    selected = selection_mask(normalize(path, version), types, window)
+    counts = incident_index(path, version).count_within(lats, lons, radius_miles, selected)
+    points, zones = zone_index(path, version, types, window, eps, min_samples).containing_many(lats, lons)
+    return counts, points, zones
+
+
+def score_track(path, version, track, radius_miles, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES):
+    """:func:`tracks.score_track` of ``track`` against the selection."""
+    df = normalize(path, version)
+    return tracks.score_track(track, df, incident_index(path, version),
+                              zone_index(path, version, types, window, eps, min_samples), radius_miles,
+                              selection_mask(df, types, window))
+
+
+def selection_mask(df, types, window=None):
+    """Boolean mask of the rows of ``df`` in the traveler types and window."""
+    selected = df["PrimaryActivity"].isin(list(types)).to_numpy()
+    if window is not None:
+        selected &= seasons.in_window(seasons.season_keys(df), window)
+    return selected
+
+
+@stage("heatmap")
+def heat(path, version, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES):
+    return heatmap.density_image(cluster(path, version, types, window, eps, min_samples))
+
+
+@stage("layer_items", maxsize=64)
+def layer_items(path, version, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES):
+    return render.map_items(normalize(path, version), cluster(path, version, types, window, eps, min_samples),
+                            hulls(path, version, types, window, eps, min_samples),
+                            heat(path, version, types, window, eps, min_samples))
+
+
+@stage("zoom_items", maxsize=64)
+def zoom_items(path, version, types, window=None, eps=EPS_DISTANCE, min_samples=MIN_SAMPLES):
+    table_id = next(iter(layer_items(path, version, types, window, eps, min_samples)))
+    return render.zoom_items(table_id, normalize(path, version),
+                             cluster(path, version, types, window, eps, min_samples))
+
+
+def map_items(path, version, types, window, eps, min_samples, zoom):
+    """:func:`render.map_items` of the selection plus its incident
+    aggregates for ``zoom``, for a :class:`render.LayerSync`."""
+    items = OrderedDict(layer_items(path, version, types, window, eps, min_samples))
+    levels = zoom_items(path, version, types, window, eps, min_samples)
+    items.update(levels[min(zoom, len(levels) - 1)])
+    return items
+
+
+@stage("filter_map", maxsize=2)
+def filter_map(path, version):
+    artifact = subsets(path, version)
+    hulls_by_subset = [artifact.hulls(types) for types in artifact.subsets]
+    return render.build_filter_map(normalize(path, version), artifact.subsets, artifact.labels, hulls_by_subset)
+
+
+@stage("playback", maxsize=2)
+def playback_map(path, version, span):
+    return playback.playback_map(normalize(path, version), span)
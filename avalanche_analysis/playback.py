@@ -0,0 +1,65 @@
+"""Season-by-season playback frames.
+
+Each frame is a trailing window of seasons ending at one season since the
+start of the record.  The cluster/hull pipeline runs once per window, all
+windows as one :func:`batch.cluster_jobs` batch, and consecutive frames are
+stored as deltas (hulls that appear and hulls that disappear), which the
+browser applies while animating; see :class:`render.SeasonPlayback`.
+"""
+import shapely
+
+from avalanche_analysis import batch, render
+from avalanche_analysis.seasons import SeasonIndex, TimeWindow
+
+# Seasons per frame; single seasons are too sparse to cluster
+SPAN = 5
+
+
+def season_windows(first, last, span=SPAN):
+    """One trailing window per season from ``first`` through ``last``."""
+    return [TimeWindow(max(first, season - span + 1), season) for season in range(first, last + 1)]
+
+
+def season_frames(df, span=SPAN, workers=None):
+    """``[(window, hulls), ...]`` for every season of ``df``.
+
+    ``workers`` is passed on to :func:`batch.cluster_jobs`.
+    """
+    first, last = SeasonIndex(df).season_range()
+    if first is None:
+        return []
+    windows = season_windows(first, last, span)
+    results = batch.cluster_jobs(df, [batch.ClusterJob(window=window) for window in windows], workers)
+    return [(window, result.hulls) for window, result in zip(windows, results)]
+
+
+def frame_deltas(frames):
+    """Polygons, hulls and per-frame deltas for :class:`render.SeasonPlayback`.
+
+    Returns ``(polygons, hulls, deltas)``: encoded rings, ``[polygon, type,
+    count]`` entries referencing them, and per frame the ids of the hulls it
+    adds and removes relative to the previous frame.
+    """
+    polygons, polygon_ids, hulls, hull_ids = [], {}, [], {}
+    deltas, previous = [], set()
+    for _, frame in frames:
+        current = set()
+        for polygon, kind, count in zip(frame.geometry, frame["traveler_type"], frame["count"]):
+            key = shapely.to_wkb(polygon)
+            if key not in polygon_ids:
+                polygon_ids[key] = len(polygons)
+                polygons.append(render.encode_ring(polygon))
+            entry = (polygon_ids[key], kind, int(count))
+            if entry not in hull_ids:
+                hull_ids[entry] = len(hulls)
+                hulls.append(list(entry))
+            current.add(hull_ids[entry])
+        deltas.append([sorted(current - previous), sorted(previous - current)])
+        previous = current
+    return polygons, hulls, deltas
+
+
+def playback_map(df, span=SPAN, workers=None):
+    """Map animating the clusters of ``df`` season by season."""
+    frames = season_frames(df, span, workers)
+    return render.build_playback_map([window for window, _ in frames], *frame_deltas(frames))
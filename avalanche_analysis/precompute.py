@@ -0,0 +1,165 @@
+"""Cluster labels and hulls precomputed for every traveler-type subset.
+
+The sidebar filter only ever selects a subset of a handful of traveler types
+(31 non-empty subsets of the five mapped types), so all of them are clustered
+once and stored in a single compressed ``.npz`` next to the workbook snapshot.
+The app then answers filter changes with a lookup.  The warm-up also builds
+the incident R-tree used by :mod:`avalanche_analysis.nearby`.
+
+Run it as a warm-up step at deploy time::
+
+    python -m avalanche_analysis.precompute CAIC_Accident_Data_Nov_2024.xlsx
+"""
+import argparse
+import glob
+import os
+from itertools import combinations
+
+import numpy as np
+import pandas as pd
+import shapely
+
+from avalanche_analysis import batch, ingest, nearby, pipeline
+
+# Labels of incidents that are not part of a subset
+NOT_SELECTED = -2
+
+
+def all_subsets(df):
+    """Every non-empty traveler-type selection the sidebar can produce."""
+    options = pipeline.types_key(df["PrimaryActivity"].unique())
+    return [combo for r in range(1, len(options) + 1) for combo in combinations(options, r)]
+
+
+def _subset_name(types):
+    return "|".join("" if t is None else t for t in types)
+
+
+def _subset_types(name):
+    return tuple(None if t == "" else t for t in name.split("|"))
+
+
+def cluster_subsets(df, subsets=None, workers=None):
+    """Run the cluster and hull stages for each subset of ``df``.
+
+    Returns ``(subsets, labels, hulls)`` where ``labels[i]`` holds the cluster
+    label of every row of ``df`` under subset ``i`` (-1 for noise,
+    ``NOT_SELECTED`` for rows outside the subset) and ``hulls[i]`` is the
+    hull GeoDataFrame produced by :func:`pipeline.build_hulls`.  The subsets
+    are clustered as one :func:`batch.cluster_jobs` batch over ``workers``.
+    """
+    subsets = all_subsets(df) if subsets is None else subsets
+    results = batch.cluster_jobs(df, [batch.ClusterJob(types) for types in subsets], workers)
+    labels = np.full((len(subsets), len(df)), NOT_SELECTED, dtype=np.int32)
+    for i, result in enumerate(results):
+        labels[i, result.rows] = result.labels
+    return subsets, labels, [result.hulls for result in results]
+
+
+def save_artifact(target, subsets, labels, hulls):
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    frame = pd.concat([h.assign(subset=i) for i, h in enumerate(hulls)], ignore_index=True)
+    share_columns = [f"share_{kind}" for kind in pipeline.TRAVELER_TYPES]
+    # Polygons are stored as one buffer of concatenated WKB plus end offsets
+    wkb = shapely.to_wkb(frame.geometry.values)
+    tmp = ingest.temp_path(target)
+    # A file object, as savez would append ".npz" to a bare name
+    with open(tmp, "wb") as f:
+        np.savez_compressed(
+            f,
+            subsets=np.array([_subset_name(s) for s in subsets], dtype=str),
+            labels=labels,
+            hull_subset=frame["subset"].to_numpy(dtype=np.int32),
+            hull_cluster=frame["cluster"].to_numpy(dtype=np.int32),
+            hull_count=frame["count"].to_numpy(dtype=np.int32),
+            hull_type=frame["traveler_type"].fillna("").to_numpy(dtype=str),
+            hull_shares=frame[share_columns].to_numpy(),
+            hull_wkb=np.frombuffer(b"".join(wkb), dtype=np.uint8),
+            hull_wkb_end=np.cumsum([len(w) for w in wkb], dtype=np.int64),
+        )
+    os.replace(tmp, target)
+
+
+class SubsetArtifact:
+    """Lookup table over a saved artifact."""
+
+    def __init__(self, target):
+        with np.load(target) as data:
+            self.labels = data["labels"]
+            self._index = {_subset_types(name): i for i, name in enumerate(data["subsets"])}
+            self.subsets = list(self._index)
+            buffer = data["hull_wkb"].tobytes()
+            ends = data["hull_wkb_end"]
+            starts = np.concatenate([[0], ends[:-1]]).astype(np.int64)
+            polygons = shapely.from_wkb(np.array([buffer[a:b] for a, b in zip(starts, ends)], dtype=object))
+            kinds = np.array([k or None for k in data["hull_type"].tolist()], dtype=object)
+
+            # Hulls of each subset are contiguous since they were concatenated in order
+            bounds = np.searchsorted(data["hull_subset"], np.arange(len(self._index) + 1))
+            self._hulls = [
+                pipeline.hull_frame(
+                    data["hull_cluster"][a:b], data["hull_count"][a:b], kinds[a:b],
+                    data["hull_shares"][a:b], polygons[a:b],
+                )
+                for a, b in zip(bounds[:-1], bounds[1:])
+            ]
+
+    def __contains__(self, types):
+        return types in self._index
+
+    def clustered(self, df, types):
+        """``df`` restricted to the clustered rows of ``types``, labelled."""
+        labels = self.labels[self._index[types]]
+        keep = labels >= 0
+        out = df[keep].copy()
+        out["cluster"] = labels[keep].astype(np.int64)
+        return out
+
+    def hulls(self, types):
+        return self._hulls[self._index[types]]
+
+
+def artifact_path_for_digest(path, digest, cache_dir=None):
+    return ingest.snapshot_path(path, digest, cache_dir)[:-len(".arrow")] + ".subsets.npz"
+
+
+def artifact_path(path, cache_dir=None):
+    return artifact_path_for_digest(path, ingest.file_digest(path), cache_dir)
+
+
+def build_artifact(path, cache_dir=None, workers=None):
+    """Cluster every subset of the workbook at ``path`` and save the artifact."""
+    target = artifact_path(path, cache_dir)
+    df = pipeline.normalize_incidents(ingest.load_incidents(path, cache_dir, columns=pipeline.INCIDENT_COLUMNS))
+    save_artifact(target, *cluster_subsets(df, workers=workers))
+    for old in glob.glob(artifact_path_for_digest(path, "*", cache_dir)):
+        if old != target:
+            os.remove(old)
+    return target
+
+
+def load_artifact(path, cache_dir=None, build=True):
+    """The artifact for the current workbook, building it if needed."""
+    target = artifact_path(path, cache_dir)
+    if not os.path.exists(target):
+        if not build:
+            return None
+        build_artifact(path, cache_dir)
+    return SubsetArtifact(target)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute clusters and hulls for every traveler-type subset.")
+    parser.add_argument("workbook", nargs="?", default="CAIC_Accident_Data_Nov_2024.xlsx")
+    parser.add_argument("--cache-dir", default=None)
+    parser.add_argument("--workers", type=int, default=None,
+                        help="clustering processes (default: one per CPU for large workbooks)")
+    args = parser.parse_args(argv)
+    print(build_artifact(args.workbook, args.cache_dir, args.workers))
+    # The incident R-tree behind the nearby lookups is persisted alongside
+    df = pipeline.normalize_incidents(ingest.load_incidents(args.workbook, args.cache_dir, columns=pipeline.INCIDENT_COLUMNS))
+    nearby.load_index(args.workbook, df, args.cache_dir).close()
+
+
+if __name__ == "__main__":
+    main()
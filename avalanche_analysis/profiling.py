@@ -0,0 +1,145 @@
+"""Opt-in wall-time, CPU-time and peak-allocation capture per stage.
+
+Profiling is off unless ``AVALANCHE_PROFILE`` is set or :func:`enable` is
+called (the app's debug sidebar has a toggle).  While off, :func:`run` calls
+straight through and :func:`measure` returns a shared null context, so the
+memoized stages pay one flag check per cache miss.
+
+While on, allocations are traced with ``tracemalloc``, which slows
+allocation-heavy stages noticeably; turn it on to diagnose, not permanently.
+Each finished stage becomes a record in a bounded, process-wide history and
+one JSON line on the ``avalanche_analysis.profile`` logger, which is written
+to ``AVALANCHE_PROFILE_LOG`` when that is set.
+"""
+import contextlib
+import json
+import logging
+import os
+import threading
+import time
+import tracemalloc
+from collections import deque
+
+import pandas as pd
+
+HISTORY = 500
+
+logger = logging.getLogger("avalanche_analysis.profile")
+
+_enabled = False
+_started_tracing = False
+_records = deque(maxlen=HISTORY)
+_lock = threading.Lock()
+_local = threading.local()
+_null = contextlib.nullcontext()
+
+
+def enabled():
+    return _enabled
+
+
+def enable(log_path=None):
+    """Start capturing.
+
+    Records are also appended as JSON lines to ``log_path`` (default
+    ``AVALANCHE_PROFILE_LOG``) when there is one.
+    """
+    global _enabled, _started_tracing
+    log_path = log_path or os.environ.get("AVALANCHE_PROFILE_LOG")
+    with _lock:
+        if not tracemalloc.is_tracing():
+            tracemalloc.start()
+            _started_tracing = True
+        if log_path and not any(getattr(h, "baseFilename", None) == os.path.abspath(log_path)
+                                for h in logger.handlers):
+            handler = logging.FileHandler(log_path)
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            logger.addHandler(handler)
+            logger.setLevel(logging.INFO)
+        _enabled = True
+
+
+def disable():
+    global _enabled, _started_tracing
+    with _lock:
+        _enabled = False
+        if _started_tracing:
+            tracemalloc.stop()
+            _started_tracing = False
+
+
+def run(name, func, *args):
+    """``func(*args)``, recorded as stage ``name`` when profiling is on."""
+    if not _enabled:
+        return func(*args)
+    with _measure(name):
+        return func(*args)
+
+
+def measure(name):
+    """Context manager recording the enclosed block as stage ``name``."""
+    return _measure(name) if _enabled else _null
+
+
+@contextlib.contextmanager
+def _measure(name):
+    # Stages nest (cluster loads normalize); tracemalloc has one peak, so each
+    # frame folds its child's peak into its own before the child resets it.
+    stack = _local.__dict__.setdefault("stack", [])
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        current, peak = tracemalloc.get_traced_memory()
+        if stack:
+            stack[-1][1] = max(stack[-1][1], peak)
+        tracemalloc.reset_peak()
+    else:
+        current = 0
+    frame = [current, current]
+    stack.append(frame)
+    wall, cpu = time.perf_counter(), time.thread_time()
+    try:
+        yield
+    finally:
+        wall, cpu = time.perf_counter() - wall, time.thread_time() - cpu
+        stack.pop()
+        peak = None
+        if tracing and tracemalloc.is_tracing():
+            peak = max(frame[1], tracemalloc.get_traced_memory()[1])
+            tracemalloc.reset_peak()
+            if stack:
+                stack[-1][1] = max(stack[-1][1], peak)
+            peak -= frame[0]
+        _record({"stage": name, "time": time.time(), "wall_seconds": wall, "cpu_seconds": cpu,
+                 "peak_bytes": peak, "thread": threading.current_thread().name, "depth": len(stack)})
+
+
+def _record(record):
+    with _lock:
+        _records.append(record)
+    logger.info(json.dumps(record))
+
+
+def records():
+    """The recorded stages, oldest first."""
+    with _lock:
+        return list(_records)
+
+
+def records_frame():
+    columns = ["stage", "time", "wall_seconds", "cpu_seconds", "peak_bytes", "thread", "depth"]
+    frame = pd.DataFrame(records(), columns=columns)
+    frame["time"] = pd.to_datetime(frame["time"], unit="s")
+    return frame
+
+
+def records_json():
+    return json.dumps(records())
+
+
+def clear():
+    with _lock:
+        _records.clear()
+
+
+if os.environ.get("AVALANCHE_PROFILE"):
+    enable()
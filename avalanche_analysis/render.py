@@ -0,0 +1,731 @@
+"""Folium map construction (the render stage)."""
+import gzip
+import hashlib
+import json
+from collections import OrderedDict
+
+import folium
+import numpy as np
+import pandas as pd
+import shapely
+from branca.element import MacroElement
+from folium.elements import JSCSSMixin
+from folium.plugins import MarkerCluster
+from jinja2 import Template
+
+from avalanche_analysis import aggregate
+from avalanche_analysis.heatmap import density_image, heat_layer
+from avalanche_analysis.seasons import season_label
+
+# Color Code for Activity Type:
+COLORDICT = {
+    "skier": "rgba(0, 0, 255, 0.5)",  # Blue with 50% opacity
+    "mechanized": "rgba(255, 0, 0, 0.5)",  # Red with 50% opacity
+    "hiker": "rgba(0, 255, 0, 0.5)",  # Green with 50% opacity
+    "occupational_hazard": "rgba(255, 165, 0, 0.5)",  # Orange with 50% opacity
+    "miscellaneous": "rgba(128, 128, 128, 0.5)",  # Gray with 50% opacity
+}
+
+
+# Zoom of every map's initial view
+START_ZOOM = 7
+
+
+def base_map():
+    """The static part of every map: tiles and the initial view."""
+    return folium.Map(location=[39.5, -105.5], zoom_start=START_ZOOM)
+
+
+def build_map(clustered, hulls, heat=None, details_url=None):
+    """Hull polygons, incident markers and a density heatmap on one map.
+
+    ``heat`` is a precomputed :func:`heatmap.density_image`; it is computed
+    from ``clustered`` when not given.  With ``details_url`` the markers
+    fetch their popup details from there (see :func:`incident_layer`).
+    """
+    m = base_map()
+
+    # Plot the polygons:
+    for polygon, traveler_type, count in zip(hulls.geometry, hulls["traveler_type"], hulls["count"]):
+        folium.Polygon(
+            locations=[(point[1], point[0]) for point in list(polygon.exterior.coords)],
+            color=COLORDICT.get(traveler_type, "gray"),  # Keeps the outline color
+            fill=True,  # Enables fill
+            fill_color=COLORDICT.get(traveler_type, "gray"),  # Uses the same transparent fill color
+            fill_opacity=0.5,  # Adjust transparency (0 = fully transparent, 1 = solid color)
+            weight=2,  # Outline thickness
+            interactive=True,  # Makes entire polygon clickable
+            popup=folium.Popup(
+                f"<b>Most at risk:</b> {traveler_type}<br>"
+                f"<b>Incidents:</b> {count}",
+                max_width=300
+            )
+        ).add_to(m)
+
+    # Add individual points to the map as clusters:
+    incident_layer(clustered, details_url).add_to(m)
+
+    # Incident density, rendered server-side as one image
+    heat = density_image(clustered) if heat is None else heat
+    if heat is not None:
+        heat_layer(heat).add_to(m)
+
+    return m
+
+
+# Builds one circle marker per data row in the browser; the popup text is
+# only assembled when a marker is clicked.
+INCIDENT_CALLBACK = """
+function (row) {
+    var colors = %s;
+    var color = colors[row[2]] || "gray";
+    var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+        radius: 5, color: color, fill: true, fillColor: color
+    });
+    marker.bindPopup(function () {
+        return "Traveler: " + row[2] + "<br>Location: " + row[3] + "<br>Date: " + row[4];
+    });
+    return marker;
+}"""
+
+
+def incident_rows(clustered):
+    """``[lat, lon, traveler, location, date]`` rows for the incident layer."""
+    rows = pd.DataFrame({
+        "lat": clustered["lat"].astype(float).round(5),
+        "lon": clustered["lon"].astype(float).round(5),
+        "traveler": clustered["PrimaryActivity"],
+        "location": clustered["Location"],
+        "date": clustered["YYYY"].astype(str) + "-" + clustered["MM"].astype(str) + "-" + clustered["DD"].astype(str),
+    })
+    return rows.astype(object).where(rows.notna(), None).values.tolist()
+
+
+# Binds marker popups whose location and date are looked up in the
+# incident_details JSON at ``url`` when a popup first opens; one request
+# serves every marker.
+DETAILS_POPUP = """
+function (url) {
+    var details = null;
+    return function (marker, traveler, id) {
+        marker.bindPopup("Traveler: " + traveler);
+        marker.on("popupopen", function () {
+            details = details || fetch(url).then(function (response) {
+                if (!response.ok) { throw new Error(response.statusText); }
+                return response.json();
+            });
+            details.then(function (data) {
+                var detail = data.rows[id];
+                marker.setPopupContent("Traveler: " + traveler + "<br>Location: " + detail[0] + "<br>Date: " + detail[1]);
+            }, function () {
+                details = null;  // Retry on the next click
+            });
+        });
+    };
+}"""
+
+# INCIDENT_CALLBACK for ``[lat, lon, traveler, id]`` rows, with DETAILS_POPUP
+LAZY_INCIDENT_CALLBACK = """
+(function () {
+    var colors = %s, popup = (%s)(%s);
+    return function (row) {
+        var color = colors[row[2]] || "gray";
+        var marker = L.circleMarker(new L.LatLng(row[0], row[1]), {
+            radius: 5, color: color, fill: true, fillColor: color
+        });
+        popup(marker, row[2], row[3]);
+        return marker;
+    };
+})()"""
+
+
+def incident_details(df):
+    """``{"rows": [[location, date], ...]}``: the popup details of the rows of
+    ``df``, in order, as written to a details file."""
+    return {"rows": [row[3:5] for row in incident_rows(df)]}
+
+
+# Keeps ``layer`` showing the aggregates ``levelAt(zoom)`` returns for the
+# map's zoom, around the view: several incidents as a counted circle in the
+# Leaflet.markercluster style, which zooms to where it splits up when
+# clicked, and single incidents as ``marker(rows[row])``.  Layers that stay
+# in view are kept, so an open popup survives its auto-pan.
+AGGREGATE_LAYER = """
+function (layer, levelAt, rows, marker) {
+    var cache = {}, shown = {};
+    function cached(key, build) {
+        if (!(key in cache)) { cache[key] = build(); }
+        return cache[key];
+    }
+    function clusterMarker(cluster) {
+        var count = cluster[2], size = count < 10 ? "small" : count < 100 ? "medium" : "large";
+        var icon = L.divIcon({html: "<div><span>" + count + "</span></div>",
+                              className: "marker-cluster marker-cluster-" + size, iconSize: L.point(40, 40)});
+        return L.marker([cluster[0], cluster[1]], {icon: icon}).on("click", function () {
+            this._map.setView([cluster[0], cluster[1]], cluster[3]);
+        });
+    }
+    function redraw() {
+        var map = layer._map, view = map.getBounds().pad(0.5), level = levelAt(Math.floor(map.getZoom()));
+        var next = {};
+        level.clusters.forEach(function (cluster) {
+            if (view.contains([cluster[0], cluster[1]])) {
+                var key = "c" + cluster.join(",");
+                next[key] = cached(key, function () { return clusterMarker(cluster); });
+            }
+        });
+        var row = -1;
+        level.singles.forEach(function (gap) {
+            row += gap;
+            if (view.contains([rows[row][0], rows[row][1]])) {
+                next["s" + row] = cached("s" + row, function () { return marker(rows[row]); });
+            }
+        });
+        Object.keys(shown).forEach(function (key) { if (!(key in next)) { layer.removeLayer(shown[key]); } });
+        Object.keys(next).forEach(function (key) { if (!(key in shown)) { layer.addLayer(next[key]); } });
+        shown = next;
+    }
+    // Bound and unbound by the map as the layer is added and removed
+    var events = {moveend: redraw};
+    layer.getEvents = function () { return events; };
+    layer.on("add", redraw);
+}"""
+
+
+def zoom_payloads(clustered, positions):
+    """``{"clusters": [[lat, lon, count, expansion], ...], "singles": gaps}``
+    for each zoom up to :data:`aggregate.MAX_ZOOM`, which shows every
+    incident on its own (see :mod:`aggregate`).
+
+    ``positions`` are the ids of the rows of ``clustered``; ``singles`` lists
+    those of the incidents drawn on their own, sorted, as gaps.
+    """
+    positions = np.asarray(positions)
+    levels = aggregate.zoom_levels(clustered["lat"], clustered["lon"])
+    payloads = []
+    for level in levels:
+        several = level.row < 0
+        clusters = zip(level.lat[several].round(5).tolist(), level.lon[several].round(5).tolist(),
+                       level.count[several].tolist(), level.expansion[several].tolist())
+        singles = np.sort(positions[level.row[~several]])
+        payloads.append({"clusters": [list(cluster) for cluster in clusters],
+                         "singles": np.diff(singles, prepend=-1).tolist()})
+    payloads.append({"clusters": [], "singles": np.diff(np.sort(positions), prepend=-1).tolist()})
+    return payloads
+
+
+class ZoomAggregates(JSCSSMixin, MacroElement):
+    """Incident markers drawn from precomputed per-zoom aggregates.
+
+    Replaces ``MarkerCluster``: the hierarchy of :func:`zoom_payloads` is
+    built in Python, and the browser only draws the aggregates of the
+    current zoom around the view.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var rows = {{ this.rows|tojson }};
+            var levels = {{ this.levels|tojson }};
+            var layer = L.layerGroup();
+            ({{ this.aggregate_layer }})(layer, function (zoom) {
+                return levels[Math.min(zoom, levels.length - 1)];
+            }, rows, {{ this.callback }});
+            layer.addTo({{ this._parent.get_name() }});
+        })();
+        {% endmacro %}
+    """)
+
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, rows, levels, callback):
+        super().__init__()
+        self._name = "ZoomAggregates"
+        self.rows = rows
+        self.levels = levels
+        self.callback = callback
+        self.aggregate_layer = AGGREGATE_LAYER
+
+
+def incident_layer(clustered, details_url=None):
+    """All incidents as one data array, aggregated per zoom (see
+    :class:`ZoomAggregates`) and drawn by a shared JS callback.
+
+    With ``details_url`` the rows carry the marker's position in
+    ``clustered`` instead of its popup text, which is fetched from the
+    :func:`incident_details` JSON at that URL.
+    """
+    rows = incident_rows(clustered)
+    levels = zoom_payloads(clustered, np.arange(len(rows)))
+    if details_url is None:
+        return ZoomAggregates(rows, levels, INCIDENT_CALLBACK % json.dumps(COLORDICT))
+    return ZoomAggregates(
+        [row[:3] + [i] for i, row in enumerate(rows)], levels,
+        LAZY_INCIDENT_CALLBACK % (json.dumps(COLORDICT), DETAILS_POPUP, json.dumps(details_url)),
+    )
+
+
+class LayerStore(JSCSSMixin, MacroElement):
+    """Map layers kept in the browser across Streamlit reruns.
+
+    Rendered inside a feature group handed to ``st_folium`` next to an
+    unchanging :func:`base_map`, so the map itself is never rebuilt.  The
+    layers are content-addressed items (see :func:`map_items` and
+    :func:`zoom_items`): each message
+    carries only the items the browser has not received yet, the ids to draw
+    and the ids to keep, as tracked by a :class:`LayerSync`.  Should the
+    browser have lost its store (the map was remounted), the element reports
+    ``{"layers_missing": epoch}`` as the map's value instead of drawing, and
+    the app resets the sync and reruns.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function (group) {
+            var store = window.avalancheLayers = window.avalancheLayers || {};
+            var added = {{ this.added|tojson }};
+            for (var id in added) { store[id] = added[id]; }
+            var keep = {};
+            {{ this.keep|tojson }}.forEach(function (id) { keep[id] = true; });
+            Object.keys(store).forEach(function (id) { if (!keep[id]) { delete store[id]; } });
+
+            var show = {{ this.show|tojson }};
+            if (show.some(function (id) { return !(id in store); })) {
+                window.parent.postMessage({isStreamlitMessage: true, type: "streamlit:setComponentValue",
+                                           value: {layers_missing: {{ this.epoch }}}, dataType: "json"}, "*");
+                return;
+            }
+            var colors = {{ this.colors|tojson }};
+            var marker = {{ this.callback }};
+            var decodeRing = {{ this.decode_ring }}, hullPolygon = {{ this.hull_polygon }};
+            show.forEach(function (id) {
+                var item = store[id];
+                if (item.kind === "hull") {
+                    hullPolygon(colors, decodeRing(item.ring), item.type, item.count).addTo(group);
+                } else if (item.kind === "markers") {
+                    // One zoom's aggregates; singles are rows of the incident table
+                    var layer = L.layerGroup();
+                    ({{ this.aggregate_layer }})(layer, function () { return item; }, store[item.table].rows, marker);
+                    group.addLayer(layer);
+                } else if (item.kind === "heat") {
+                    L.imageOverlay(item.url, item.bounds, {opacity: item.opacity}).addTo(group);
+                }
+            });
+        })({{ this._parent.get_name() }});
+        {% endmacro %}
+    """)
+
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, added, show, keep, epoch):
+        super().__init__()
+        self._name = "LayerStore"
+        self.colors = COLORDICT
+        self.decode_ring = DECODE_RING
+        self.hull_polygon = HULL_POLYGON
+        self.callback = INCIDENT_CALLBACK % json.dumps(COLORDICT)
+        self.aggregate_layer = AGGREGATE_LAYER
+        self.added = added
+        self.show = show
+        self.keep = keep
+        self.epoch = epoch
+
+
+def _item_id(text):
+    return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+def map_items(df, clustered, hulls, heat=None):
+    """The hull, incident and density layers of :func:`build_map` as
+    ``{id: (item, size)}`` in drawing order, for :class:`LayerSync`.
+
+    Every hull is an item of its own, so a filter change only ships the
+    hulls that are new to the browser.  The incident rows of the whole
+    normalized ``df`` are one table item, sent once per workbook and always
+    first; markers (see :func:`zoom_items`) refer to its rows.  The density
+    image is one item.  Ids are content hashes and ``size`` the JSON length
+    of the item.
+    """
+    table = json.dumps({"kind": "table", "rows": incident_rows(df)}, separators=(",", ":"))
+    table_id = _item_id(table)
+    items = [{"kind": "hull", "ring": encode_ring(polygon), "type": kind, "count": int(count)}
+             for polygon, kind, count in zip(hulls.geometry, hulls["traveler_type"], hulls["count"])]
+    heat = density_image(clustered) if heat is None else heat
+    if heat is not None:
+        overlay = heat_layer(heat)
+        items.append({"kind": "heat", "url": overlay.url, "bounds": overlay.bounds,
+                      "opacity": overlay.options.get("opacity", 1.0)})
+    encoded = [json.dumps(item, separators=(",", ":")) for item in items]
+    layers = OrderedDict([(table_id, (json.loads(table), len(table)))])
+    layers.update((_item_id(text), (item, len(text))) for item, text in zip(items, encoded))
+    return layers
+
+
+def zoom_items(table_id, df, clustered):
+    """The markers item of each zoom (see :func:`zoom_payloads`), as
+    :func:`map_items` does the other layers; singles are rows of ``df`` in
+    the table item ``table_id``."""
+    items = []
+    for payload in zoom_payloads(clustered, df.index.get_indexer(clustered.index)):
+        item = {"kind": "markers", "table": table_id, **payload}
+        text = json.dumps(item, separators=(",", ":"))
+        items.append(OrderedDict([(_item_id(text), (item, len(text)))]))
+    return items
+
+
+class LayerSync:
+    """The items one browser map holds, for :class:`LayerStore` messages.
+
+    Kept per Streamlit session.  Items beyond ``budget`` bytes are dropped
+    oldest first, on both sides.  ``epoch`` counts resets; the map value
+    still reports a loss from before the last reset after it, so only a
+    loss reported for the current epoch calls for one.
+    """
+
+    def __init__(self, budget=8 << 20):
+        self.budget = budget
+        self.epoch = 0
+        self._held = OrderedDict()
+
+    def layer(self, items):
+        """Feature group drawing ``items`` (from :func:`map_items`)."""
+        added = {key: item for key, (item, _) in items.items() if key not in self._held}
+        for key, (_, size) in items.items():
+            self._held[key] = size
+            self._held.move_to_end(key)
+        total = sum(self._held.values())
+        while total > self.budget and len(self._held) > len(items):
+            total -= self._held.popitem(last=False)[1]
+        group = folium.FeatureGroup(name="Clusters", control=False)
+        LayerStore(added, list(items), list(self._held), self.epoch).add_to(group)
+        return group
+
+    def lost(self, state):
+        """Whether ``st_folium`` returned ``state`` reports a loss to reset for."""
+        return (state or {}).get("layers_missing") == self.epoch
+
+    def reset(self):
+        self._held.clear()
+        self.epoch += 1
+
+
+class TravelerFilter(JSCSSMixin, MacroElement):
+    """In-browser traveler-type filter over every precomputed subset.
+
+    Incidents are shipped once as rows ``[lat, lon, type, mask, location,
+    date]`` where bit ``i`` of ``mask`` says whether the incident is
+    clustered under subset ``i``.  With ``details_url`` the location and
+    date are replaced by the row's position in ``df``, and popups fetch them
+    from the :func:`incident_details` of ``df`` at that URL.  Hull polygons are shipped once and each
+    subset lists the polygons it shows.  Ticking a type only swaps markers
+    and hull layers in the browser.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var colors = {{ this.colors|tojson }};
+            var detailsUrl = {{ this.details_url|tojson }};
+            var popup = detailsUrl === null ? null : ({{ this.details_popup }})(detailsUrl);
+            var options = {{ this.options|tojson }};
+            var subsets = {{ this.subsets|tojson }};
+            var rows = {{ this.rows|tojson }};
+            var hullPolygon = {{ this.hull_polygon }};
+            var polygons = {{ this.polygons|tojson }}.map({{ this.decode_ring }});
+            var selected = options.slice();
+
+            var cluster = L.markerClusterGroup({disableClusteringAtZoom: 10}).addTo(map);
+            var markers = rows.map(function (row) {
+                var color = colors[row[2]] || "gray";
+                var marker = L.circleMarker([row[0], row[1]], {radius: 5, color: color, fill: true, fillColor: color});
+                if (popup) {
+                    popup(marker, row[2], row[4]);
+                } else {
+                    marker.bindPopup(function () {
+                        return "Traveler: " + row[2] + "<br>Location: " + row[4] + "<br>Date: " + row[5];
+                    });
+                }
+                return marker;
+            });
+
+            var hulls = L.layerGroup().addTo(map);
+            var hullLayers = {};
+            function hullLayer(index) {
+                if (!(index in hullLayers)) {
+                    hullLayers[index] = L.layerGroup(subsets[index].hulls.map(function (hull) {
+                        return hullPolygon(colors, polygons[hull[0]], hull[1], hull[2]);
+                    }));
+                }
+                return hullLayers[index];
+            }
+
+            function update() {
+                var key = options.filter(function (t) { return selected.indexOf(t) >= 0; }).join("|");
+                var index = -1;
+                for (var i = 0; i < subsets.length; i++) { if (subsets[i].key === key) { index = i; } }
+                hulls.clearLayers();
+                cluster.clearLayers();
+                if (index < 0) { return; }
+                hulls.addLayer(hullLayer(index));
+                var word = Math.floor(index / 31), bit = 1 << (index % 31);
+                cluster.addLayers(markers.filter(function (marker, i) { return rows[i][3][word] & bit; }));
+            }
+
+            var control = L.control({position: "topright"});
+            control.onAdd = function () {
+                var div = L.DomUtil.create("div", "leaflet-bar");
+                div.style.background = "white";
+                div.style.padding = "6px 8px";
+                div.innerHTML = "<b>Traveler type</b><br>" + options.map(function (t) {
+                    return '<label style="display:block"><input type="checkbox" checked value="' + t + '"> ' +
+                        '<span style="color:' + (colors[t] || "gray") + '">&#9632;</span> ' + (t || "unmapped") + "</label>";
+                }).join("");
+                L.DomEvent.disableClickPropagation(div);
+                div.addEventListener("change", function () {
+                    selected = Array.prototype.filter.call(div.querySelectorAll("input"), function (box) {
+                        return box.checked;
+                    }).map(function (box) { return box.value; });
+                    update();
+                });
+                return div;
+            };
+            control.addTo(map);
+            update();
+        })();
+        {% endmacro %}
+    """)
+
+    default_js = MarkerCluster.default_js
+    default_css = MarkerCluster.default_css
+
+    def __init__(self, df, subsets, labels, hulls, details_url=None):
+        super().__init__()
+        self._name = "TravelerFilter"
+        self.colors = COLORDICT
+        self.details_url = details_url
+        self.details_popup = DETAILS_POPUP
+        self.decode_ring = DECODE_RING
+        self.hull_polygon = HULL_POLYGON
+        names = ["" if t is None else t for t in sorted({t for s in subsets for t in s}, key=str)]
+        self.options = names
+
+        # One membership bit per subset, packed 31 to an int so JS bit
+        # operations stay in range
+        clustered = labels >= 0
+        keep = clustered.any(axis=0)
+        words = -(-len(subsets) // 31)
+        masks = np.zeros((len(df), words), dtype=np.int64)
+        for i in range(len(subsets)):
+            masks[:, i // 31] |= clustered[i].astype(np.int64) << (i % 31)
+        rows = incident_rows(df[keep])
+        for row, mask, position in zip(rows, masks[keep].tolist(), np.flatnonzero(keep).tolist()):
+            row[2] = "" if row[2] is None else row[2]
+            row[3:] = [mask] + (row[3:5] if details_url is None else [position])
+        self.rows = rows
+
+        # Identical hulls recur across subsets; ship each polygon once
+        polygons, seen = [], {}
+        self.subsets = []
+        for types, frame in zip(subsets, hulls):
+            entries = []
+            for polygon, kind, count in zip(frame.geometry, frame["traveler_type"], frame["count"]):
+                key = shapely.to_wkb(polygon)
+                if key not in seen:
+                    seen[key] = len(polygons)
+                    polygons.append(encode_ring(polygon))
+                entries.append([seen[key], kind, int(count)])
+            self.subsets.append({"key": "|".join("" if t is None else t for t in types), "hulls": entries})
+        self.polygons = polygons
+
+
+# Hull outlines are simplified to ~100 m (the hull buffer is ~5 km) and sent
+# as delta-encoded integer lat/lon in units of 1e-4 degrees
+RING_TOLERANCE = 0.001
+RING_SCALE = 1e4
+
+
+def encode_ring(polygon):
+    """Flat ``[dlat, dlon, ...]`` integer deltas of the simplified outline."""
+    coords = np.asarray(polygon.simplify(RING_TOLERANCE).exterior.coords)[:, ::-1]
+    fixed = np.round(coords * RING_SCALE).astype(np.int64)
+    return np.diff(fixed, axis=0, prepend=0).ravel().tolist()
+
+
+# The [[lat, lon], ...] outline of an encode_ring list
+DECODE_RING = """
+function (deltas) {
+    var ring = [], lat = 0, lon = 0;
+    for (var i = 0; i < deltas.length; i += 2) {
+        lat += deltas[i];
+        lon += deltas[i + 1];
+        ring.push([lat / %r, lon / %r]);
+    }
+    return ring;
+}""" % (RING_SCALE, RING_SCALE)
+
+# A hull polygon on ``ring`` with its popup; ``kind`` is the dominant
+# traveler type, null when there is none
+HULL_POLYGON = """
+function (colors, ring, kind, count) {
+    var color = colors[kind] || "gray";
+    return L.polygon(ring, {color: color, fill: true, fillColor: color, fillOpacity: 0.5, weight: 2})
+        .bindPopup("<b>Most at risk:</b> " + (kind || "none") + "<br><b>Incidents:</b> " + count, {maxWidth: 300});
+}"""
+
+
+def build_filter_map(df, subsets, labels, hulls, details_url=None):
+    """Map with every traveler-type subset precomputed and filtered in the browser.
+
+    ``subsets``, ``labels`` and ``hulls`` are as produced by
+    :func:`precompute.cluster_subsets` for the rows of ``df``; see
+    :class:`TravelerFilter` for ``details_url``.
+    """
+    m = base_map()
+    TravelerFilter(df, subsets, labels, hulls, details_url).add_to(m)
+    return m
+
+
+class SeasonPlayback(JSCSSMixin, MacroElement):
+    """Season-by-season animation of the cluster hulls.
+
+    Every distinct hull is shipped once; each frame lists the hulls it adds
+    and removes relative to the previous one, so stepping, playing or
+    dragging the slider only adds and removes layers in the browser.
+    """
+
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+        (function () {
+            var map = {{ this._parent.get_name() }};
+            var colors = {{ this.colors|tojson }};
+            var labels = {{ this.labels|tojson }};
+            var hulls = {{ this.hulls|tojson }};
+            var deltas = {{ this.deltas|tojson }};
+            var hullPolygon = {{ this.hull_polygon }};
+            var polygons = {{ this.polygons|tojson }}.map({{ this.decode_ring }});
+
+            var group = L.layerGroup().addTo(map);
+            var layers = {};
+            function layer(id) {
+                if (!(id in layers)) {
+                    var hull = hulls[id];
+                    layers[id] = hullPolygon(colors, polygons[hull[0]], hull[1], hull[2]);
+                }
+                return layers[id];
+            }
+
+            var frame = -1;
+            function apply(index, forward) {
+                var add = deltas[index][forward ? 0 : 1], remove = deltas[index][forward ? 1 : 0];
+                remove.forEach(function (id) { group.removeLayer(layer(id)); });
+                add.forEach(function (id) { group.addLayer(layer(id)); });
+            }
+            function show(target) {
+                while (frame < target) { apply(++frame, true); }
+                while (frame > target) { apply(frame--, false); }
+                slider.value = frame;
+                label.innerHTML = labels[frame];
+            }
+
+            var timer = null, slider, label, button;
+            function stop() { clearInterval(timer); timer = null; button.innerHTML = "&#9654;"; }
+            function play() {
+                if (frame === labels.length - 1) { show(0); }
+                button.innerHTML = "&#10074;&#10074;";
+                timer = setInterval(function () {
+                    if (frame >= labels.length - 1) { stop(); } else { show(frame + 1); }
+                }, {{ this.interval }});
+            }
+
+            var control = L.control({position: "bottomleft"});
+            control.onAdd = function () {
+                var div = L.DomUtil.create("div", "leaflet-bar");
+                div.style.background = "white";
+                div.style.padding = "6px 8px";
+                div.innerHTML = '<button type="button" style="width:2.5em">&#9654;</button> ' +
+                    '<input type="range" min="0" max="' + (labels.length - 1) + '" value="0" style="width:300px;vertical-align:middle"> ' +
+                    '<b></b>';
+                button = div.querySelector("button");
+                slider = div.querySelector("input");
+                label = div.querySelector("b");
+                L.DomEvent.disableClickPropagation(div);
+                button.addEventListener("click", function () { if (timer) { stop(); } else { play(); } });
+                slider.addEventListener("input", function () { stop(); show(+slider.value); });
+                return div;
+            };
+            control.addTo(map);
+            if (labels.length) { show(0); }
+        })();
+        {% endmacro %}
+    """)
+
+    def __init__(self, windows, polygons, hulls, deltas, interval=800):
+        super().__init__()
+        self._name = "SeasonPlayback"
+        self.colors = COLORDICT
+        self.decode_ring = DECODE_RING
+        self.hull_polygon = HULL_POLYGON
+        self.labels = [season_label(w.last) if w.first == w.last else f"{season_label(w.first)} \u2013 {season_label(w.last)}"
+                       for w in windows]
+        self.polygons = polygons
+        self.hulls = hulls
+        self.deltas = deltas
+        self.interval = interval
+
+
+def build_playback_map(windows, polygons, hulls, deltas):
+    """Map animating :func:`playback.frame_deltas` frames over ``windows``."""
+    m = base_map()
+    SeasonPlayback(windows, polygons, hulls, deltas).add_to(m)
+    return m
+
+
+def minify_html(html):
+    """Strip indentation and blank lines.
+
+    Lines are kept intact, so inline scripts relying on automatic semicolon
+    insertion still parse.
+    """
+    return "\n".join(line.strip() for line in html.splitlines() if line.strip())
+
+
+def _brotli(data):
+    try:
+        import brotli
+    except ImportError:
+        raise RuntimeError("brotli compression needs the 'brotli' package") from None
+    return brotli.compress(data, quality=11)
+
+
+COMPRESSORS = {
+    "gzip": (".gz", lambda data: gzip.compress(data, compresslevel=9, mtime=0)),
+    "brotli": (".br", _brotli),
+}
+
+
+def write_map(m, out, minify=True, compress=()):
+    """Write the standalone HTML of ``m`` to ``out`` plus one pre-compressed
+    sibling per entry of ``compress`` (``"gzip"``, ``"brotli"``).
+
+    Returns the paths written.
+    """
+    html = m.get_root().render()
+    return _write((minify_html(html) if minify else html).encode("utf-8"), out, compress)
+
+
+def write_json(data, out, compress=()):
+    """Write ``data`` as compact JSON to ``out``, compressed as :func:`write_map`."""
+    return _write(json.dumps(data, separators=(",", ":")).encode("utf-8"), out, compress)
+
+
+def _write(data, out, compress):
+    written = [out]
+    with open(out, "wb") as f:
+        f.write(data)
+    for name in compress:
+        suffix, compressor = COMPRESSORS[name]
+        with open(out + suffix, "wb") as f:
+            f.write(compressor(data))
+        written.append(out + suffix)
+    return written
@@ -0,0 +1,114 @@
+"""Season and month slicing through a sorted (season, month) index.
+
+Avalanche seasons straddle the new year, so incidents are bucketed by season:
+season ``Y`` runs from October of ``Y - 1`` through September of ``Y``.
+:class:`SeasonIndex` sorts the row positions of a normalized frame once by
+(season, month-of-season); a :class:`TimeWindow` then resolves to a few
+``searchsorted`` slices of that order instead of a boolean scan of every row.
+"""
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+
+FIRST_MONTH = 10
+MONTH_NAMES = ("Oct", "Nov", "Dec", "Jan", "Feb", "Mar", "Apr", "May", "Jun", "Jul", "Aug", "Sep")
+
+# Month-of-season slots: 0..11 for Oct..Sep, then one for a missing month
+_SLOTS = 13
+_NO_MONTH = 12
+_NO_YEAR = np.iinfo(np.int64).max
+
+
+class TimeWindow(NamedTuple):
+    """Seasons ``first``..``last`` and months ``first_month``..``last_month``.
+
+    Months are calendar months taken in season order, so (12, 3) means
+    December through March.  Incidents without a month only fall in windows
+    covering the whole season.
+    """
+    first: int
+    last: int
+    first_month: int = FIRST_MONTH
+    last_month: int = FIRST_MONTH - 1
+
+    @classmethod
+    def decade(cls, start):
+        """The ten seasons from ``start`` (e.g. 1990 for 1990-1999)."""
+        return cls(start, start + 9)
+
+    @property
+    def whole_season(self):
+        return self.first_month == FIRST_MONTH and self.last_month == FIRST_MONTH - 1
+
+
+def season_month(month):
+    """Position of calendar ``month`` within the season (October is 0)."""
+    return (month - FIRST_MONTH) % 12
+
+
+def seasons(df):
+    """Season of each incident (nullable ints), from its ``YYYY`` and ``MM``."""
+    year = df["YYYY"].astype("Int64")
+    return year + (df["MM"].astype("Int64") >= FIRST_MONTH).fillna(False).astype("Int64")
+
+
+def season_keys(df):
+    """Sortable (season, month-of-season) key per incident.
+
+    Incidents without a month sort after the months of their season, those
+    without a year after everything.
+    """
+    season = seasons(df)
+    slot = season_month(df["MM"].astype("Int64")).fillna(_NO_MONTH).to_numpy(dtype=np.int64)
+    return np.where(season.isna(), _NO_YEAR, season.fillna(0).to_numpy(dtype=np.int64) * _SLOTS + slot)
+
+
+def window_bounds(window):
+    """``[[lo, hi), ...]`` key ranges covering ``window``, one per season at most."""
+    if window.whole_season:
+        return np.array([[window.first * _SLOTS, (window.last + 1) * _SLOTS]])
+    first, last = season_month(window.first_month), season_month(window.last_month)
+    if first > last:
+        raise ValueError(f"months {window.first_month}..{window.last_month} run past the end of the season")
+    starts = np.arange(window.first, window.last + 1) * _SLOTS
+    return np.column_stack([starts + first, starts + last + 1])
+
+
+def in_window(keys, window):
+    """Mask of the :func:`season_keys` ``keys`` falling in ``window``."""
+    bounds = window_bounds(window)
+    slot = np.searchsorted(bounds[:, 0], keys, side="right") - 1
+    return (slot >= 0) & (keys < bounds[np.maximum(slot, 0), 1])
+
+
+class SeasonIndex:
+    """Row positions of a frame ordered by (season, month-of-season)."""
+
+    def __init__(self, df):
+        keys = season_keys(df)
+        self.order = np.argsort(keys, kind="stable")
+        self.keys = keys[self.order]
+        known = self.keys[self.keys != _NO_YEAR] // _SLOTS
+        self.first = int(known[0]) if len(known) else None
+        self.last = int(known[-1]) if len(known) else None
+
+    def season_range(self):
+        return self.first, self.last
+
+    def rows(self, window):
+        """Sorted positions (``df.iloc`` order) of the rows in ``window``."""
+        bounds = window_bounds(window)
+        lo, hi = np.searchsorted(self.keys, bounds[:, 0]), np.searchsorted(self.keys, bounds[:, 1])
+        picked = [self.order[a:b] for a, b in zip(lo, hi) if b > a]
+        # Back in frame order, which DBSCAN's cluster numbering depends on
+        return np.sort(np.concatenate(picked)) if picked else np.empty(0, dtype=np.int64)
+
+    def slice(self, df, window):
+        """The rows of ``df`` (the indexed frame) in ``window``."""
+        return df.iloc[self.rows(window)]
+
+
+def season_label(season):
+    """'2023/24' for season 2024."""
+    return f"{season - 1}/{str(season)[-2:]}" if not pd.isna(season) else "unknown"
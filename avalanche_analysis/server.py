@@ -0,0 +1,305 @@
+"""Local HTTP API over the cluster zones, for route-planning tools.
+
+    python -m avalanche_analysis serve --port 8765
+
+Endpoints answer in JSON.  ``types`` is a comma-separated traveler-type
+selection (all types by default, as in the app); ``radius`` is in miles.
+
+    GET  /health
+    GET  /zones?types=skier,hiker               cluster zones as GeoJSON
+    GET  /lookup?lat=39.6&lon=-106.1&radius=5   zones containing a point, incidents near it
+    POST /lookup                                many points, see :meth:`ZoneService.lookup_many`
+    POST /track?radius=1                        GPX or GeoJSON track body, see :meth:`ZoneService.track`
+    GET  /profile                               stage profile records
+
+The server is plain ``asyncio`` streams speaking HTTP/1.1: connections are
+kept alive between requests and responses are gzipped for clients that
+accept it.  Answers come from the memoized pipeline stages and the
+:mod:`nearby` indexes, which are loaded before the port opens; requests are
+answered in worker threads so a large batch does not stall other clients.
+"""
+import argparse
+import asyncio
+import gzip
+import json
+import logging
+from functools import partial
+from http import HTTPStatus
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+
+from avalanche_analysis import pipeline, profiling, tracks
+
+logger = logging.getLogger(__name__)
+
+MAX_BODY = 16 << 20
+MAX_POINTS = 100_000
+DEFAULT_RADIUS = 5
+DEFAULT_TRACK_RADIUS = 1
+MAX_RADIUS = 100
+# Smaller responses are sent as they are
+GZIP_MIN_BYTES = 1024
+# Seconds an idle keep-alive connection stays open
+IDLE_TIMEOUT = 30
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class ZoneService:
+    """The lookups behind the endpoints, for the workbook at ``path``."""
+
+    def __init__(self, path):
+        self.path = path
+        # Load the frame, hulls and both indexes up front
+        version = pipeline.source_version(path)
+        pipeline.incident_index(path, version)
+        pipeline.zone_index(path, version, self.types(None))
+
+    def _version(self):
+        return pipeline.source_version(self.path)
+
+    def types(self, value):
+        """Traveler-type selection from a comma-separated string or list."""
+        if value is None:
+            df = pipeline.normalize(self.path, self._version())
+            return pipeline.types_key(df["PrimaryActivity"].unique())
+        names = value.split(",") if isinstance(value, str) else value
+        if not isinstance(names, list) or not all(isinstance(name, str) for name in names):
+            raise HTTPError(HTTPStatus.BAD_REQUEST, "types must be a list of traveler types")
+        unknown = set(names) - set(pipeline.TRAVELER_TYPES)
+        if unknown or not names:
+            raise HTTPError(HTTPStatus.BAD_REQUEST,
+                            f"types must be from {', '.join(pipeline.TRAVELER_TYPES)}, got {sorted(unknown) or 'none'}")
+        return pipeline.types_key(names)
+
+    def health(self):
+        return {"status": "ok", "incidents": len(pipeline.normalize(self.path, self._version()))}
+
+    def zones(self, types=None):
+        hulls = pipeline.hulls(self.path, self._version(), self.types(types))
+        return json.loads(hulls.to_json())
+
+    def lookup(self, lat, lon, radius=DEFAULT_RADIUS, types=None):
+        """Zones containing ``(lat, lon)`` and the incidents within ``radius``."""
+        found, zones = pipeline.near(self.path, self._version(), lat, lon, radius, self.types(types))
+        return {"zones": _zone_records(zones), "incidents": _incident_records(found)}
+
+    def lookup_many(self, points, radius=DEFAULT_RADIUS, types=None):
+        """Zones and nearby incident counts for each of ``points`` (``[[lat, lon], ...]``).
+
+        Returns ``{"zones": {cluster: {...}}, "points": [{"zones": [cluster, ...],
+        "nearby": count}, ...]}``, each zone described once.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+        version = self._version()
+        types = self.types(types)
+        counts, hits, rows = pipeline.near_many(self.path, version, points[:, 0], points[:, 1], radius, types)
+        hulls = pipeline.zone_index(self.path, version, types).hulls
+        clusters = hulls["cluster"].to_numpy()[rows]
+        bounds = np.searchsorted(hits, np.arange(len(points) + 1))
+        return {
+            "zones": {str(zone["cluster"]): zone for zone in _zone_records(hulls.iloc[np.unique(rows)])},
+            "points": [{"zones": clusters[a:b].tolist(), "nearby": int(count)}
+                       for a, b, count in zip(bounds[:-1], bounds[1:], counts)],
+        }
+
+    def track(self, data, radius=DEFAULT_TRACK_RADIUS, types=None):
+        """Zones a GPX or GeoJSON track crosses, with the miles inside each,
+        and the incidents within ``radius`` of it."""
+        try:
+            line = tracks.read_track(data)
+        except ValueError as error:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, str(error)) from None
+        result = pipeline.score_track(self.path, self._version(), line, radius, self.types(types))
+        zones = _zone_records(result.zones)
+        for zone, miles in zip(zones, result.zones["miles_in_zone"]):
+            zone["miles_in_zone"] = round(float(miles), 3)
+        return {"length_miles": round(result.length_miles, 3), "zones": zones,
+                "incidents": _incident_records(result.nearby)}
+
+
+def _incident_records(found):
+    return [
+        {"year": _value(row.YYYY), "month": _value(row.MM), "location": _value(row.Location),
+         "traveler_type": _value(row.PrimaryActivity), "distance_miles": round(row.distance_miles, 3)}
+        for row in found.itertuples()
+    ]
+
+
+def _value(value):
+    """``value`` as a JSON-safe scalar; missing values become null."""
+    if pd.isna(value):
+        return None
+    return value.item() if isinstance(value, np.generic) else value
+
+
+def _zone_records(hulls):
+    shares = [f"share_{kind}" for kind in pipeline.TRAVELER_TYPES]
+    return [
+        {"cluster": int(cluster), "count": int(count), "traveler_type": kind,
+         "shares": dict(zip(pipeline.TRAVELER_TYPES, np.round(row, 4).tolist()))}
+        for cluster, count, kind, row in zip(hulls["cluster"], hulls["count"], hulls["traveler_type"],
+                                             hulls[shares].to_numpy())
+    ]
+
+
+def _number(query, name, default=None, high=None):
+    if name not in query:
+        if default is None:
+            raise HTTPError(HTTPStatus.BAD_REQUEST, f"missing {name}")
+        return default
+    try:
+        value = float(query[name])
+    except (TypeError, ValueError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} must be a number") from None
+    if not np.isfinite(value) or (high is not None and not 0 < value <= high):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, f"{name} out of range")
+    return value
+
+
+def _get_lookup(service, query, body):
+    return service.lookup(_number(query, "lat"), _number(query, "lon"),
+                          _number(query, "radius", DEFAULT_RADIUS, MAX_RADIUS), query.get("types"))
+
+
+def _post_lookup(service, query, body):
+    try:
+        request = json.loads(body)
+        points = np.asarray(request["points"], dtype=np.float64)
+    except (ValueError, KeyError, TypeError):
+        raise HTTPError(HTTPStatus.BAD_REQUEST, 'expected {"points": [[lat, lon], ...]}') from None
+    if points.ndim != 2 or points.shape[1] != 2 or not np.isfinite(points).all():
+        raise HTTPError(HTTPStatus.BAD_REQUEST, "points must be [lat, lon] pairs")
+    if len(points) > MAX_POINTS:
+        raise HTTPError(HTTPStatus.REQUEST_ENTITY_TOO_LARGE, f"at most {MAX_POINTS} points per request")
+    radius = _number(request, "radius", DEFAULT_RADIUS, MAX_RADIUS)
+    return service.lookup_many(points, radius, request.get("types"))
+
+
+def _post_track(service, query, body):
+    return service.track(body, _number(query, "radius", DEFAULT_TRACK_RADIUS, MAX_RADIUS), query.get("types"))
+
+
+ROUTES = {
+    "/health": {"GET": lambda service, query, body: service.health()},
+    "/zones": {"GET": lambda service, query, body: service.zones(query.get("types"))},
+    "/lookup": {"GET": _get_lookup, "POST": _post_lookup},
+    "/track": {"POST": _post_track},
+    "/profile": {"GET": lambda service, query, body: profiling.records()},
+}
+
+
+def respond(service, method, target, body, gzip_ok):
+    """``(status, headers, body)`` for one request."""
+    url = urlsplit(target)
+    try:
+        methods = ROUTES.get(url.path)
+        if methods is None:
+            raise HTTPError(HTTPStatus.NOT_FOUND, f"no endpoint {url.path}")
+        if method not in methods:
+            raise HTTPError(HTTPStatus.METHOD_NOT_ALLOWED, f"{url.path} takes {', '.join(methods)}")
+        status, payload = HTTPStatus.OK, methods[method](service, dict(parse_qsl(url.query)), body)
+    except HTTPError as error:
+        status, payload = error.status, {"error": str(error)}
+    except Exception:
+        logger.exception("%s %s failed", method, target)
+        status, payload = HTTPStatus.INTERNAL_SERVER_ERROR, {"error": "internal error"}
+
+    data = json.dumps(payload, separators=(",", ":")).encode()
+    headers = {"Content-Type": "application/json", "Vary": "Accept-Encoding"}
+    if gzip_ok and len(data) >= GZIP_MIN_BYTES:
+        data = gzip.compress(data, compresslevel=6, mtime=0)
+        headers["Content-Encoding"] = "gzip"
+    return status, headers, data
+
+
+def accepts_gzip(value):
+    for coding in value.split(","):
+        name, _, params = coding.strip().partition(";")
+        if name.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+async def handle(service, reader, writer):
+    """Serve requests on one connection until it closes or goes idle."""
+    try:
+        while True:
+            try:
+                head = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), IDLE_TIMEOUT)
+            except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                return
+            except asyncio.LimitOverrunError:
+                await _send(writer, HTTPStatus.REQUEST_HEADER_FIELDS_TOO_LARGE, {}, b"", False)
+                return
+            try:
+                request_line, *lines = head.decode("latin-1").split("\r\n")
+                method, target, version = request_line.split(" ")
+                headers = {}
+                for line in filter(None, lines):
+                    name, _, value = line.partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                length = int(headers.get("content-length", 0))
+                if length < 0:
+                    raise ValueError("negative Content-Length")
+            except ValueError:
+                await _send(writer, HTTPStatus.BAD_REQUEST, {}, b"", False)
+                return
+            if "transfer-encoding" in headers:
+                await _send(writer, HTTPStatus.LENGTH_REQUIRED, {}, b"", False)
+                return
+            if length > MAX_BODY:
+                await _send(writer, HTTPStatus.REQUEST_ENTITY_TOO_LARGE, {}, b"", False)
+                return
+            body = await reader.readexactly(length) if length else b""
+
+            connection = headers.get("connection", "").lower()
+            keep_alive = connection != "close" if version == "HTTP/1.1" else connection == "keep-alive"
+            gzip_ok = accepts_gzip(headers.get("accept-encoding", ""))
+            status, response_headers, data = await asyncio.to_thread(
+                respond, service, method, target, body, gzip_ok)
+            await _send(writer, status, response_headers, data, keep_alive)
+            if not keep_alive:
+                return
+    except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _send(writer, status, headers, data, keep_alive):
+    headers = {**headers, "Content-Length": str(len(data)),
+               "Connection": "keep-alive" if keep_alive else "close"}
+    if keep_alive:
+        headers["Keep-Alive"] = f"timeout={IDLE_TIMEOUT}"
+    lines = [f"HTTP/1.1 {status.value} {status.phrase}"] + [f"{k}: {v}" for k, v in headers.items()]
+    writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1") + data)
+    await writer.drain()
+
+
+async def serve(path, host="127.0.0.1", port=8765):
+    service = await asyncio.to_thread(ZoneService, path)
+    server = await asyncio.start_server(partial(handle, service), host, port)
+    logger.info("serving %s on http://%s:%d", path, host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m avalanche_analysis serve",
+                                     description="Serve cluster zone lookups over local HTTP.")
+    parser.add_argument("--workbook", default="CAIC_Accident_Data_Nov_2024.xlsx")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    try:
+        asyncio.run(serve(args.workbook, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,462 @@
+"""Mapbox Vector Tile export of the incidents and their cluster hulls.
+
+Folium inlines every geometry into the page, which stops scaling for
+statewide, multi-decade data.  :func:`write_tiles` instead cuts the clustered
+incidents and the hull polygons into MVT tiles for a range of zoom levels and
+stores them in a single archive: PMTiles, which any static file server can
+serve through HTTP range requests, or MBTiles (SQLite), picked by the file
+suffix.  Every feature keeps its attributes (traveler type, year, cluster id,
+...), so a style can filter on them.
+
+Only varints and length-delimited fields are needed to write the MVT and
+PMTiles encodings, so both are written out here rather than pulling in a
+protobuf toolchain.
+"""
+import gzip
+import json
+import os
+import sqlite3
+import struct
+from collections import defaultdict
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry.polygon import orient
+
+from avalanche_analysis import pipeline
+
+EXTENT = 4096
+# Geometry kept past each tile edge so symbols and outlines do not clip
+BUFFER = 64
+MAX_LAT = 85.0511287798
+
+INCIDENT_LAYER = "incidents"
+HULL_LAYER = "clusters"
+
+_POINT, _POLYGON = 1, 3
+_MOVE_TO, _LINE_TO, _CLOSE_PATH = 1, 2, 7
+
+
+# Protobuf encoding:
+
+def _encode_varint(value):
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+# Tile coordinates, tags and lengths are nearly always below 2**14
+_SMALL_VARINTS = [_encode_varint(v) for v in range(1 << 14)]
+
+
+def _varint(value):
+    return _SMALL_VARINTS[value] if value < 16384 else _encode_varint(value)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(number, wire_type):
+    return _varint((number << 3) | wire_type)
+
+
+def _field(number, payload):
+    return _key(number, 2) + _varint(len(payload)) + payload
+
+
+def _packed(number, values):
+    return _field(number, b"".join(map(_varint, values)))
+
+
+def _value_field(value):
+    """A layer's ``values`` entry for a str, bool, int or float."""
+    if isinstance(value, str):
+        encoded = _field(1, value.encode())
+    elif isinstance(value, bool):
+        encoded = _key(7, 0) + _varint(int(value))
+    elif isinstance(value, int):
+        encoded = _key(6, 0) + _varint(_zigzag(value))
+    else:
+        encoded = _key(3, 1) + struct.pack("<d", value)
+    return _field(4, encoded)
+
+
+def _layer(name, features, keys, values):
+    """Encoded layer from encoded features, its keys and its value fields.
+
+    ``values`` are complete ``Value`` fields (see :func:`_value_field`), which
+    callers encode once per distinct value rather than per tile.
+    """
+    return b"".join([
+        _key(15, 0), _varint(2),
+        _field(1, name.encode()),
+        *features,
+        *(_field(3, key.encode()) for key in keys),
+        *values,
+        _key(5, 0), _varint(EXTENT),
+    ])
+
+
+def _varints(values, present):
+    """Each row of non-negative ``values`` as concatenated varints.
+
+    Cells where ``present`` is false are left out, so every row can carry a
+    different number of fields.
+    """
+    values = values.ravel()
+    lengths = np.where(present.ravel(), _varint_lengths(values), 0)
+    start = np.cumsum(lengths) - lengths
+    out = np.zeros(lengths.sum(), dtype=np.uint8)
+    for k in range(5):
+        more = lengths > k
+        out[start[more] + k] = ((values[more] >> (7 * k)) & 0x7F) | ((lengths[more] > k + 1) << 7)
+    return out.tobytes()
+
+
+def _varint_lengths(values):
+    return 1 + sum((values >= 1 << (7 * k)).astype(np.int64) for k in range(1, 5))
+
+
+class _Layer:
+    """One MVT layer being filled feature by feature."""
+
+    def __init__(self, name):
+        self.name = name
+        self.keys = {}
+        self.values = {}
+        self.features = []
+
+    def add(self, kind, geometry, properties):
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(self.keys.setdefault(key, len(self.keys)))
+            # Keyed by type too: 1, 1.0 and True are distinct tile values
+            tags.append(self.values.setdefault((type(value), value), len(self.values)))
+        feature = _packed(2, tags) + _key(3, 0) + _varint(kind) + _packed(4, geometry)
+        self.features.append(_field(2, feature))
+
+    def encode(self):
+        return _layer(self.name, self.features, self.keys, [_value_field(value) for _, value in self.values])
+
+
+def _command(command, count):
+    return (count << 3) | command
+
+
+def _ring(geometry, coords, cursor):
+    """Append a closed ring (without its repeated last point) to ``geometry``."""
+    for i, (x, y) in enumerate(coords):
+        if i == 0:
+            geometry.append(_command(_MOVE_TO, 1))
+        elif i == 1:
+            geometry.append(_command(_LINE_TO, len(coords) - 1))
+        geometry += (_zigzag(x - cursor[0]), _zigzag(y - cursor[1]))
+        cursor = (x, y)
+    geometry.append(_command(_CLOSE_PATH, 1))
+    return cursor
+
+
+def _polygon_geometry(polygons):
+    geometry, cursor = [], (0, 0)
+    for polygon in polygons:
+        # MVT wants exterior rings with positive area in tile coordinates
+        # (y down), interior rings with negative area
+        polygon = orient(polygon, 1.0)
+        for ring in [polygon.exterior, *polygon.interiors]:
+            coords = np.asarray(ring.coords, dtype=np.int64)[:-1].tolist()
+            if len(coords) >= 3:
+                cursor = _ring(geometry, coords, cursor)
+    return geometry
+
+
+# Tiling:
+
+def mercator(lon, lat):
+    """Web Mercator position in the unit square, y pointing south."""
+    lat = np.radians(np.clip(lat, -MAX_LAT, MAX_LAT))
+    x = (np.asarray(lon, dtype=np.float64) + 180) / 360
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / np.pi) / 2
+    return x, y
+
+
+def _point_tiles(x, y, z):
+    """``(point, tx, ty)`` for every tile each point falls in, buffer included."""
+    scale = 1 << z
+    pad = BUFFER / EXTENT
+    px, py = x * scale, y * scale
+    columns = [np.clip(np.floor(px + d), 0, scale - 1).astype(np.int64) for d in (-pad, pad)]
+    rows = [np.clip(np.floor(py + d), 0, scale - 1).astype(np.int64) for d in (-pad, pad)]
+    # One integer per (point, tile), so duplicates drop with a 1-d unique
+    index = np.arange(len(x), dtype=np.int64)
+    found = np.unique(np.concatenate([(index * scale + tx) * scale + ty for tx in columns for ty in rows]))
+    return found // scale // scale, found // scale % scale, found % scale
+
+
+def incident_columns(clustered):
+    """``(key, codes, values)`` per incident attribute.
+
+    ``codes`` index the attribute's encoded value fields, -1 where it is
+    missing.
+    """
+    columns = []
+    for key, column, cast in [
+        ("cluster", "cluster", int),
+        ("traveler_type", "PrimaryActivity", str),
+        ("year", "YYYY", int),
+        ("month", "MM", int),
+        ("day", "DD", int),
+        ("location", "Location", str),
+    ]:
+        codes, uniques = pd.factorize(clustered[column])
+        columns.append((key, codes.astype(np.int64), [_value_field(cast(v)) for v in uniques]))
+    return columns
+
+
+def _incident_layers(columns, x, y, z):
+    """``((tx, ty), layer)`` for every tile holding incidents at zoom ``z``.
+
+    Features are encoded for a whole tile at once with numpy; each is a
+    point with its attributes, tagged against the tile's own value table.
+    """
+    scale = 1 << z
+    point, tx, ty = _point_tiles(x, y, z)
+    tile = tx * scale + ty
+    order = np.argsort(tile, kind="stable")
+    point, tile = point[order], tile[order]
+    px = np.rint((x[point] * scale - tile // scale) * EXTENT).astype(np.int64)
+    py = np.rint((y[point] * scale - tile % scale) * EXTENT).astype(np.int64)
+    keys = [key for key, _, _ in columns]
+
+    bounds = np.flatnonzero(np.diff(tile)) + 1
+    for rows in np.split(np.arange(len(point)), bounds) if len(point) else []:
+        idx, n = point[rows], len(rows)
+        tags, present, values = [], [], []
+        for k, (_, codes, encoded) in enumerate(columns):
+            used, local = np.unique(codes[idx], return_inverse=True)
+            if used[0] < 0:
+                used, local = used[1:], local - 1
+            has = local >= 0
+            tags += [np.full(n, k), len(values) + local]
+            present += [has, has]
+            values += [encoded[u] for u in used]
+        tags, present = np.column_stack(tags), np.column_stack(present)
+
+        # Feature: tags (2), type (3) and a single MoveTo (4), each prefixed
+        # by its field key and, where length-delimited, its length
+        tag_length = np.where(present, _varint_lengths(tags), 0).sum(axis=1)
+        geometry = [np.full(n, _command(_MOVE_TO, 1)), _zigzag(px[rows]), _zigzag(py[rows])]
+        geometry_length = sum(_varint_lengths(g) for g in geometry)
+        feature_length = (1 + _varint_lengths(tag_length) + tag_length
+                          + 2
+                          + 1 + _varint_lengths(geometry_length) + geometry_length)
+        const = lambda value: np.full(n, value)  # noqa: E731
+        cells = np.column_stack([
+            const(0x12), feature_length,
+            const(0x12), tag_length, tags,
+            const(0x18), const(_POINT),
+            const(0x22), geometry_length, *geometry,
+        ])
+        mask = np.column_stack([np.ones((n, 4), dtype=bool), present, np.ones((n, 7), dtype=bool)])
+        features = _varints(cells, mask)
+        yield (int(tile[rows[0]] // scale), int(tile[rows[0]] % scale)), _layer(INCIDENT_LAYER, [features], keys, values)
+
+
+def hull_properties(hulls):
+    properties = []
+    for row in hulls.drop(columns="geometry").itertuples(index=False):
+        row = row._asdict()
+        properties.append({
+            "cluster": int(row["cluster"]),
+            "count": int(row["count"]),
+            "traveler_type": row["traveler_type"],
+            **{f"share_{kind}": round(float(row[f"share_{kind}"]), 3) for kind in pipeline.TRAVELER_TYPES},
+        })
+    return properties
+
+
+def build_tiles(clustered, hulls, minzoom=0, maxzoom=12):
+    """``{(z, x, y): mvt_bytes}`` for the incidents and hulls over the zooms."""
+    x, y = mercator(clustered["lon"].to_numpy(dtype=np.float64), clustered["lat"].to_numpy(dtype=np.float64))
+    incidents = incident_columns(clustered)
+    polygons = shapely.transform(hulls.geometry.to_numpy(), lambda c: np.column_stack(mercator(c[:, 0], c[:, 1])))
+    polygon_props = hull_properties(hulls)
+
+    tiles = {}
+    for z in range(minzoom, maxzoom + 1):
+        hull_layers = defaultdict(lambda: _Layer(HULL_LAYER))
+        world = float(EXTENT << z)
+
+        for geom, props in zip(polygons, polygon_props):
+            scaled = shapely.transform(geom, lambda c: c * world)
+            west, north, east, south = (np.asarray(scaled.bounds) + [-BUFFER, -BUFFER, BUFFER, BUFFER]) // EXTENT
+            for tx in range(max(int(west), 0), min(int(east), (1 << z) - 1) + 1):
+                for ty in range(max(int(north), 0), min(int(south), (1 << z) - 1) + 1):
+                    x0, y0 = tx * EXTENT, ty * EXTENT
+                    clipped = shapely.clip_by_rect(scaled, x0 - BUFFER, y0 - BUFFER, x0 + EXTENT + BUFFER, y0 + EXTENT + BUFFER)
+                    local = shapely.set_precision(shapely.transform(clipped, lambda c: c - (x0, y0)), 1.0)
+                    parts = [p for p in shapely.get_parts(local) if p.geom_type == "Polygon" and not p.is_empty]
+                    geometry = _polygon_geometry(parts)
+                    if geometry:
+                        hull_layers[(tx, ty)].add(_POLYGON, geometry, props)
+
+        layers = defaultdict(list)
+        for tile, layer in hull_layers.items():
+            layers[tile].append(layer.encode())
+        for tile, layer in _incident_layers(incidents, x, y, z):
+            layers[tile].append(layer)
+        for (tx, ty), encoded in layers.items():
+            tiles[(z, tx, ty)] = b"".join(_field(3, layer) for layer in encoded)
+    return tiles
+
+
+def vector_layers(minzoom, maxzoom):
+    """TileJSON ``vector_layers`` describing the two layers' attributes."""
+    return [
+        {"id": INCIDENT_LAYER, "minzoom": minzoom, "maxzoom": maxzoom,
+         "fields": {"cluster": "Number", "traveler_type": "String", "year": "Number",
+                    "month": "Number", "day": "Number", "location": "String"}},
+        {"id": HULL_LAYER, "minzoom": minzoom, "maxzoom": maxzoom,
+         "fields": {"cluster": "Number", "count": "Number", "traveler_type": "String",
+                    **{f"share_{kind}": "Number" for kind in pipeline.TRAVELER_TYPES}}},
+    ]
+
+
+# Archives:
+
+def zxy_to_tileid(z, x, y):
+    """PMTiles tile id: tiles of lower zooms first, then Hilbert order."""
+    tileid = ((1 << (2 * z)) - 1) // 3
+    for a in range(z - 1, -1, -1):
+        s = 1 << a
+        rx, ry = s & x, s & y
+        tileid += ((3 * rx) ^ ry) << a
+        if ry == 0:
+            if rx:
+                x, y = s - 1 - x, s - 1 - y
+            x, y = y, x
+    return tileid
+
+
+_PMTILES_HEADER = struct.Struct("<7sB11Q6B4iB2i")
+_PMTILES_ROOT_LIMIT = 16384 - _PMTILES_HEADER.size
+_GZIP = 2
+_MVT = 1
+
+
+def _directory(entries):
+    previous = [0] + [tileid for tileid, _, _, _ in entries[:-1]]
+    follows = [i > 0 and offset == entries[i - 1][1] + entries[i - 1][2] for i, (_, offset, _, _) in enumerate(entries)]
+    out = b"".join([
+        _varint(len(entries)),
+        *(_varint(tileid - last) for (tileid, _, _, _), last in zip(entries, previous)),
+        *(_varint(run_length) for _, _, _, run_length in entries),
+        *(_varint(length) for _, _, length, _ in entries),
+        *(_varint(0 if follow else offset + 1) for (_, offset, _, _), follow in zip(entries, follows)),
+    ])
+    return gzip.compress(out, mtime=0)
+
+
+def _directories(entries):
+    """Root directory and (possibly empty) leaf directories."""
+    root = _directory(entries)
+    leaf_size = 4096
+    while len(root) > _PMTILES_ROOT_LIMIT:
+        leaves, pointers = bytearray(), []
+        for start in range(0, len(entries), leaf_size):
+            leaf = _directory(entries[start:start + leaf_size])
+            pointers.append((entries[start][0], len(leaves), len(leaf), 0))
+            leaves += leaf
+        root = _directory(pointers)
+        if len(root) <= _PMTILES_ROOT_LIMIT:
+            return root, bytes(leaves)
+        leaf_size *= 2
+    return root, b""
+
+
+def write_pmtiles(tiles, out, metadata, bounds, minzoom, maxzoom):
+    """Write gzipped ``{(z, x, y): bytes}`` tiles as a PMTiles v3 archive."""
+    data, entries, seen = bytearray(), [], {}
+    for tileid, content in sorted((zxy_to_tileid(*zxy), content) for zxy, content in tiles.items()):
+        offset = seen.get(content)
+        if offset is None:
+            offset = seen[content] = len(data)
+            data += content
+        last = entries[-1] if entries else None
+        if last and last[1] == offset and last[0] + last[3] == tileid:
+            entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+        else:
+            entries.append((tileid, offset, len(content), 1))
+
+    root, leaves = _directories(entries)
+    meta = gzip.compress(json.dumps(metadata).encode(), mtime=0)
+    (south, west), (north, east) = bounds
+    center_zoom = min(maxzoom, max(minzoom, 7))
+    root_offset = _PMTILES_HEADER.size
+    meta_offset = root_offset + len(root)
+    leaf_offset = meta_offset + len(meta)
+    data_offset = leaf_offset + len(leaves)
+    header = _PMTILES_HEADER.pack(
+        b"PMTiles", 3,
+        root_offset, len(root), meta_offset, len(meta), leaf_offset, len(leaves), data_offset, len(data),
+        sum(e[3] for e in entries), len(entries), len(seen),
+        1, _GZIP, _GZIP, _MVT, minzoom, maxzoom,
+        *(round(v * 1e7) for v in (west, south, east, north)),
+        center_zoom, round((west + east) / 2 * 1e7), round((south + north) / 2 * 1e7),
+    )
+    _atomic_write(out, [header, root, meta, leaves, data])
+
+
+def write_mbtiles(tiles, out, metadata, bounds, minzoom, maxzoom):
+    """Write gzipped ``{(z, x, y): bytes}`` tiles as an MBTiles (SQLite) file."""
+    (south, west), (north, east) = bounds
+    tmp = f"{out}.tmp{os.getpid()}"
+    if os.path.exists(tmp):
+        os.remove(tmp)
+    with sqlite3.connect(tmp) as db:
+        db.execute("CREATE TABLE metadata (name text, value text)")
+        db.execute("CREATE TABLE tiles (zoom_level integer, tile_column integer, tile_row integer, tile_data blob)")
+        db.execute("CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)")
+        db.executemany("INSERT INTO metadata VALUES (?, ?)", [
+            ("name", metadata["name"]), ("format", "pbf"),
+            ("minzoom", str(minzoom)), ("maxzoom", str(maxzoom)),
+            ("bounds", f"{west},{south},{east},{north}"),
+            ("center", f"{(west + east) / 2},{(south + north) / 2},{min(maxzoom, max(minzoom, 7))}"),
+            ("json", json.dumps({"vector_layers": metadata["vector_layers"]})),
+        ])
+        # MBTiles rows count from the south (TMS)
+        db.executemany("INSERT INTO tiles VALUES (?, ?, ?, ?)",
+                       [(z, x, (1 << z) - 1 - y, content) for (z, x, y), content in tiles.items()])
+    os.replace(tmp, out)
+
+
+def _atomic_write(out, chunks):
+    tmp = f"{out}.tmp{os.getpid()}"
+    with open(tmp, "wb") as f:
+        for chunk in chunks:
+            f.write(chunk)
+    os.replace(tmp, out)
+
+
+ARCHIVES = {".pmtiles": write_pmtiles, ".mbtiles": write_mbtiles}
+
+
+def write_tiles(clustered, hulls, out, minzoom=0, maxzoom=12, name="Avalanche incidents"):
+    """Write the tile archive for ``out``'s suffix; returns the tile count."""
+    suffix = os.path.splitext(out)[1].lower()
+    if suffix not in ARCHIVES:
+        raise ValueError(f"unsupported tile archive {out!r}; use one of {', '.join(ARCHIVES)}")
+    tiles = {zxy: gzip.compress(content, compresslevel=6, mtime=0)
+             for zxy, content in build_tiles(clustered, hulls, minzoom, maxzoom).items()}
+    lat, lon = clustered["lat"].to_numpy(dtype=float), clustered["lon"].to_numpy(dtype=float)
+    bounds = ([[lat.min(), lon.min()], [lat.max(), lon.max()]] if len(clustered)
+              else [[-MAX_LAT, -180.0], [MAX_LAT, 180.0]])
+    metadata = {"name": name, "format": "pbf", "vector_layers": vector_layers(minzoom, maxzoom)}
+    ARCHIVES[suffix](tiles, out, metadata, bounds, minzoom, maxzoom)
+    return len(tiles)
@@ -0,0 +1,137 @@
+"""Score a GPX or GeoJSON track against the cluster zones.
+
+A track is read into one (Multi)LineString in lon/lat degrees.  The zones it
+crosses come from a single ``STRtree`` query, and the stretch inside each
+zone from one vectorized ``shapely.intersection``, measured along the great
+circle.  Nearby incidents are the R-tree candidates in the track's
+per-segment boxes, kept when their distance to the track (in a local UTM
+projection) is within the radius.  There is no per-point Python loop, so a
+10k-point track scores in milliseconds.
+"""
+import json
+import xml.etree.ElementTree as ElementTree
+from typing import NamedTuple
+
+import numpy as np
+import pandas as pd
+import shapely
+from shapely.geometry import shape
+
+from avalanche_analysis import nearby
+from avalanche_analysis.clustering import project
+
+METERS_PER_MILE = 1609.344
+
+# Track segments covered by one R-tree query box; fewer, larger boxes trade
+# index probes for a few more exact distance checks
+SEGMENTS_PER_BOX = 32
+
+
+class TrackScore(NamedTuple):
+    """``zones``: the hull rows crossed, with ``miles_in_zone``, longest first;
+    ``nearby``: incident rows within the radius, with ``distance_miles``,
+    nearest first."""
+    length_miles: float
+    zones: pd.DataFrame
+    nearby: pd.DataFrame
+
+
+def read_track(data):
+    """The track in GPX or GeoJSON ``data`` (text or bytes) as a shapely line.
+
+    GPX track and route points are read segment by segment; GeoJSON may be a
+    geometry, Feature or FeatureCollection of (Multi)LineStrings.  Elevations
+    are dropped.  Raises ValueError for anything else.
+    """
+    text = data.decode("utf-8-sig") if isinstance(data, bytes) else data
+    try:
+        if text.lstrip().startswith("{"):
+            parts = _geojson_parts(json.loads(text))
+        else:
+            parts = _gpx_parts(ElementTree.fromstring(text))
+    except (ElementTree.ParseError, KeyError, TypeError, AttributeError, ValueError,
+            shapely.errors.ShapelyError) as error:
+        raise ValueError(f"not a GPX or GeoJSON track ({error})") from None
+    parts = [part for part in parts if len(part) >= 2]
+    if not parts:
+        raise ValueError("no track with two or more points found")
+    lines = shapely.linestrings(np.concatenate(parts), indices=np.repeat(np.arange(len(parts)), [len(p) for p in parts]))
+    return lines[0] if len(lines) == 1 else shapely.multilinestrings(lines)
+
+
+def _gpx_parts(root):
+    parts = []
+    for element in root.iter():
+        tag = element.tag.rsplit("}", 1)[-1]
+        if tag in ("trkseg", "rte"):
+            points = [child for child in element if child.tag.rsplit("}", 1)[-1] in ("trkpt", "rtept")]
+            parts.append(np.array([[float(p.get("lon")), float(p.get("lat"))] for p in points]).reshape(-1, 2))
+    return parts
+
+
+def _geojson_parts(data):
+    if data.get("type") == "FeatureCollection":
+        return [part for feature in data["features"] for part in _geojson_parts(feature)]
+    if data.get("type") == "Feature":
+        return _geojson_parts(data["geometry"]) if data.get("geometry") else []
+    geometry = shapely.force_2d(shape(data))
+    lines = shapely.get_parts(geometry)
+    lines = lines[shapely.get_type_id(lines) == shapely.GeometryType.LINESTRING]
+    return [shapely.get_coordinates(line) for line in lines]
+
+
+def line_miles(geometries):
+    """Great-circle length in miles of each lon/lat geometry (0 for points)."""
+    geometries = np.asarray(geometries, dtype=object)
+    parts, owner = shapely.get_parts(geometries, return_index=True)
+    coords, part = shapely.get_coordinates(parts, return_index=True)
+    same = part[1:] == part[:-1]
+    miles = nearby.haversine_miles(coords[:-1, 1], coords[:-1, 0], coords[1:, 1], coords[1:, 0])
+    per_part = np.bincount(part[1:][same], miles[same], minlength=len(parts))
+    return np.bincount(owner, per_part, minlength=len(geometries))
+
+
+def _run_boxes(coords, part, radius_miles):
+    """Search boxes (see :func:`nearby.search_boxes`) covering every segment
+    within ``radius_miles``, one per run of :data:`SEGMENTS_PER_BOX` segments."""
+    ends = [nearby.search_boxes(coords[i, 1], coords[i, 0], radius_miles) for i in (slice(None, -1), slice(1, None))]
+    boxes = np.hstack([np.minimum(ends[0][:, :2], ends[1][:, :2]), np.maximum(ends[0][:, 2:], ends[1][:, 2:])])
+    segment = np.flatnonzero(part[1:] == part[:-1])
+    if len(segment) == 0:
+        return boxes[:0]
+    # Runs never span two parts
+    run = part[segment] * len(coords) + (segment - np.searchsorted(part, part[segment])) // SEGMENTS_PER_BOX
+    starts = np.flatnonzero(np.r_[True, run[1:] != run[:-1]])
+    boxes = boxes[segment]
+    return np.hstack([np.minimum.reduceat(boxes[:, :2], starts), np.maximum.reduceat(boxes[:, 2:], starts)])
+
+
+def score_track(track, df, incidents, zones, radius_miles, selected=None):
+    """:class:`TrackScore` of ``track`` (see :func:`read_track`).
+
+    ``df`` is the normalized frame behind the :class:`nearby.IncidentIndex`
+    ``incidents``; ``zones`` a :class:`nearby.ZoneIndex`; ``selected`` an
+    optional boolean row mask limiting the incidents counted.
+    """
+    length = float(line_miles([track])[0])
+
+    crossed = zones.crossing(track)
+    pieces = shapely.intersection(track, zones.hulls.geometry.values[crossed])
+    crossed_zones = zones.hulls.iloc[crossed].drop(columns="geometry").assign(miles_in_zone=line_miles(pieces))
+    crossed_zones = crossed_zones.sort_values("miles_in_zone", ascending=False, kind="stable")
+
+    # Candidates from one box per run of segments, then the exact distance to the line
+    parts = shapely.get_parts(track)
+    coords, part = shapely.get_coordinates(parts, return_index=True)
+    rows = incidents.in_boxes(_run_boxes(coords, part, radius_miles))
+    if selected is not None:
+        rows = rows[selected[rows]]
+    points = df[["lat", "lon"]].to_numpy(dtype=np.float64)[rows]
+    # One projection for both, so the distances are in the same plane
+    xy = project(np.radians(np.concatenate([coords[:, ::-1], points])))
+    line = shapely.multilinestrings(shapely.linestrings(xy[:len(coords)], indices=part))
+    meters = shapely.distance(line, shapely.points(xy[len(coords):]))
+    near = meters <= radius_miles * METERS_PER_MILE
+    order = np.argsort(meters[near], kind="stable")
+    found = df.iloc[rows[near][order]].assign(distance_miles=meters[near][order] / METERS_PER_MILE)
+    return TrackScore(length, crossed_zones, found)
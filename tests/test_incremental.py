@@ -0,0 +1,63 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from avalanche_analysis import bench, pipeline
+from avalanche_analysis.incremental import IncrementalClustering
+
+
+def incidents(n, seed):
+    # Tight hotspots, so appends both grow and merge clusters
+    return pipeline.normalize_incidents(bench.synthetic_incidents(n, seed, hotspots=12, spread=0.05))
+
+
+def far_apart(lats, lons):
+    df = incidents(len(lats), 0)
+    return df.assign(lat=np.asarray(lats, dtype=np.float64), lon=np.asarray(lons, dtype=np.float64))
+
+
+@pytest.mark.parametrize("min_samples", [2, 3, 5])
+@pytest.mark.parametrize("seed", range(5))
+def test_random_appends_match_full_recompute(min_samples, seed):
+    df = incidents(400, seed).sample(frac=1, random_state=seed)
+    rng = np.random.default_rng(seed)
+    start = int(rng.integers(2, 50))
+    state = IncrementalClustering(df.iloc[:start], min_samples=min_samples)
+    assert state.verify()
+    while start < len(df):
+        stop = start + int(rng.integers(1, 30))
+        state.append(df.iloc[start:stop])
+        assert state.verify()
+        start = stop
+
+
+def test_all_noise():
+    df = far_apart([31.5, 35.0, 40.0, 48.0], [-124.0, -115.0, -110.0, -103.0])
+    state = IncrementalClustering(df.iloc[:3])
+    assert state.append(df.iloc[3:]) == set()
+    assert (state.labels == -1).all()
+    assert state.hulls.empty
+    assert state.verify()
+
+
+def test_cluster_forms_after_noise():
+    df = far_apart([31.5, 40.0, 48.0, 40.001, 40.002], [-124.0, -110.0, -103.0, -110.001, -110.002])
+    state = IncrementalClustering(df.iloc[:3])
+    state.append(df.iloc[3:4])
+    assert state.verify()
+    assert state.append(df.iloc[4:]) == {0}
+    assert len(state.hulls) == 1
+    assert state.verify()
+
+
+@pytest.mark.parametrize("min_samples", [2, 3, 5])
+def test_append_with_overlapping_index(min_samples):
+    # A fresh export numbers its rows from 0 again
+    first, second = incidents(300, 1), incidents(300, 2)
+    assert first.index.equals(second.index)
+    state = IncrementalClustering(first, min_samples=min_samples)
+    for chunk in np.array_split(np.arange(len(second)), 4):
+        state.append(second.iloc[chunk])
+        assert state.verify()
+    full = pipeline.build_hulls(pipeline.cluster_incidents(pd.concat([first, second]), min_samples=min_samples))
+    assert len(state.hulls) == len(full)
@@ -0,0 +1,21 @@
+import pytest
+
+from avalanche_analysis import tracks
+
+
+def test_reads_geojson_line():
+    track = tracks.read_track('{"type": "LineString", "coordinates": [[-106.0, 39.5, 3000], [-106.1, 39.6, 3100]]}')
+    assert track.wkt == "LINESTRING (-106 39.5, -106.1 39.6)"
+
+
+@pytest.mark.parametrize("data", [
+    "garbage",
+    b"<gpx><trk><trkseg><trkpt lat='39.5'/></trkseg></trk></gpx>",
+    '{"type": "Feature", "geometry": {"type": "Bogus"}}',
+    '{"type": "LineString", "coordinates": [[0, 0], [1]]}',
+    '{"type": "Point", "coordinates": [1, 2]}',
+    '{"type": ',
+])
+def test_bad_input_raises_value_error(data):
+    with pytest.raises(ValueError):
+        tracks.read_track(data)